@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Times the choosers, quantization and rendering on generated (and optionally
+# fixture) images, and compares the results against a stored baseline so that
+# slowdowns and worse solutions fail loudly. Runs offline on a CPU.
+#
+#   python benchmark.py -o results.json                  # record
+#   python benchmark.py -o results.json -b baseline.json # record and compare
+
+import argparse
+import json
+import os
+import platform
+import resource
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from greedy_chooser import GreedyChooser
+from max_pool_resize_chooser import MaxPoolResizeChooser
+from pam_chooser import PamChooser
+from pulp_chooser import PulpChooser
+from utils import quantize_img
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-o", "--output", help="path to write the JSON results to")
+ap.add_argument("-b", "--baseline", help="path of earlier results to compare against")
+ap.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.25,
+    help="fraction by which a case may be slower than the baseline",
+)
+ap.add_argument(
+    "--min-slack",
+    type=float,
+    default=0.05,
+    help="seconds by which any case may be slower, to ignore timer noise",
+)
+ap.add_argument(
+    "-r", "--repeat", type=int, default=3, help="runs per case, the fastest is kept"
+)
+ap.add_argument("-f", "--fixtures", help="directory of extra images to benchmark")
+ap.add_argument("--quick", action="store_true", help="only use the small images")
+ap.add_argument(
+    "-",
+    "--color-options",
+    type=str,
+    help="path to numpy file of colors to use",
+    default="color_names.json",
+)
+
+
+def synthetic_image(kind, width, height, seed=0):
+    """
+    Generates a test image. "flat" is a few solid shapes, like the artwork many
+    templates are made from; "photo" is smooth gradients plus noise, so that
+    nearly every pixel is a distinct color.
+    """
+    rng = np.random.default_rng(seed)
+    if kind == "flat":
+        img = np.full((height, width, 3), (40, 120, 200), np.uint8)
+        for _ in range(12):
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            radius = int(
+                rng.integers(min(width, height) // 20, min(width, height) // 4)
+            )
+            if rng.random() < 0.5:
+                cv2.circle(img, center, radius, color, -1)
+            else:
+                corner = (center[0] + radius, center[1] + radius)
+                cv2.rectangle(img, center, corner, color, -1)
+        return img
+    elif kind == "photo":
+        rows, cols = np.mgrid[0:height, 0:width]
+        img = np.dstack(
+            (
+                cols * 255 / width,
+                rows * 255 / height,
+                (rows + cols) * 255 / (width + height),
+            )
+        )
+        img += rng.normal(0, 12, img.shape)
+        return np.clip(img, 0, 255).astype(np.uint8)
+    raise ValueError(f"unknown image kind: {kind}")
+
+
+def measure(fn, repeat):
+    """
+    Runs fn repeat times, returning its last result and the fastest wall time, then
+    once more under tracemalloc (which slows Python code down too much to time) to
+    get the peak memory allocated through Python during a run.
+    """
+    best_seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best_seconds, peak_bytes
+
+
+def get_cases(color_options, images):
+    """
+    Returns (name, function) pairs for every case to run on the given named images.
+    Each function returns a dict of extra values to record, such as the cost.
+    """
+    cases = []
+    for image_name, img in images.items():
+        rows, cols = img.shape[:2]
+
+        def quantize(img=img):
+            quantize_img(img, GreedyChooser(color_options).palette)
+            return {}
+
+        cases.append((f"quantize_img/{image_name}", quantize))
+
+        choosers = [
+            ("greedy", GreedyChooser, {}, 120, 12),
+            ("greedy-shortlist", GreedyChooser, {"shortlist_size": 30}, 120, 12),
+            ("pam", PamChooser, {}, 120, 12),
+            ("mpr", MaxPoolResizeChooser, {}, 120, 12),
+            ("pulp", PulpChooser, {"time_limit": 20}, 120, 12),
+        ]
+        for method, chooser_class, kwargs, long_side, clusters in choosers:
+            chooser = chooser_class(color_options, **kwargs)
+            if cols >= rows:
+                width, height = chooser.get_dimentions(img, long_side, None)
+            else:
+                width, height = chooser.get_dimentions(img, None, long_side)
+
+            def choose(
+                chooser=chooser, img=img, clusters=clusters, size=(width, height)
+            ):
+                result_img = chooser.choose_colors_body(img, clusters, *size)
+                return {"cost": chooser.template_cost(img, result_img, *size)}
+
+            cases.append((f"{method}/{image_name}", choose))
+
+        chooser = GreedyChooser(color_options)
+        width, height = chooser.get_dimentions(img, None, None)
+        result_img = chooser.choose_colors_body(img, 12, width, height)
+        _, color_order = chooser.make_color_stats(result_img)
+
+        def stats(chooser=chooser, result_img=result_img):
+            chooser.make_color_stats(result_img)
+            return {}
+
+        def render(chooser=chooser, result_img=result_img, color_order=color_order):
+            chooser.add_lines_and_symbols(result_img, color_order)
+            return {}
+
+        cases.append((f"make_color_stats/{image_name}", stats))
+        cases.append((f"add_lines_and_symbols/{image_name}", render))
+    return cases
+
+
+def compare(results, baseline, tolerance, min_slack):
+    """
+    Returns a list of messages describing cases which got slower or found a worse
+    solution than in the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        allowed = max(old["seconds"] * (1 + tolerance), old["seconds"] + min_slack)
+        if result["seconds"] > allowed:
+            regressions.append(
+                f"{name}: {result['seconds']:.3f}s, baseline {old['seconds']:.3f}s"
+            )
+        if "cost" in old and result.get("cost", 0) > old["cost"] * (1 + 1e-9):
+            regressions.append(
+                f"{name}: cost {result['cost']:.0f}, baseline {old['cost']:.0f}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    args = ap.parse_args()
+
+    with open(args.color_options) as f:
+        color_options = {name: np.array(color) for name, color in json.load(f).items()}
+
+    sizes = [("small", 400, 300)]
+    if not args.quick:
+        sizes.append(("large", 1600, 1200))
+    images = {
+        f"{kind}-{size_name}": synthetic_image(kind, width, height)
+        for kind in ("flat", "photo")
+        for size_name, width, height in sizes
+    }
+    if args.fixtures is not None:
+        for f in sorted(os.listdir(args.fixtures)):
+            img = cv2.imread(os.path.join(args.fixtures, f))
+            if img is not None:
+                images[os.path.splitext(f)[0]] = img
+
+    results = {}
+    for name, fn in get_cases(color_options, images):
+        extra, seconds, peak_bytes = measure(fn, args.repeat)
+        results[name] = {
+            "seconds": seconds,
+            "peak_traced_bytes": peak_bytes,
+            # ru_maxrss is the high water mark of the whole process so far, in KiB
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            **extra,
+        }
+        cost = f", cost {extra['cost']:.0f}" if "cost" in extra else ""
+        print(f"{name}: {seconds:.3f}s, peak {peak_bytes / 2**20:.1f} MiB{cost}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "machine": platform.platform(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "opencv": cv2.__version__,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance, args.min_slack)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print("no regressions against the baseline")
@@ -1,23 +1,179 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
 import json
+import multiprocessing
 import os
+import re
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 import cv2
 import numpy as np
 
 from greedy_chooser import GreedyChooser
+from image_loader import load_image
+from instrumentation import Instrumentation, JsonLogSink, ProfileSink, TextSink
+from metrics import METRICS
+from pam_chooser import PamChooser
 from pulp_chooser import PulpChooser
 from max_pool_resize_chooser import MaxPoolResizeChooser
+from result_cache import ResultCache
 
 ap = argparse.ArgumentParser()
-ap.add_argument("-i", "--image", required=True, help="Path to the image")
-ap.add_argument("-c", "--clusters", required=True, type=int, help="# of clusters")
+inputs = ap.add_mutually_exclusive_group(required=True)
+inputs.add_argument("-i", "--image", help="Path to the image")
+inputs.add_argument(
+    "-b",
+    "--batch",
+    help="directory of images, glob pattern, or manifest file with one image path "
+    "per line, to process in parallel",
+)
+ap.add_argument(
+    "-j",
+    "--workers",
+    type=int,
+    default=os.cpu_count(),
+    help="number of worker processes for --batch",
+)
+ap.add_argument("-c", "--clusters", type=int, help="# of clusters")
+ap.add_argument(
+    "--sweep",
+    type=int,
+    nargs=2,
+    metavar=("MIN", "MAX"),
+    help="choose colors for every # of clusters from MIN to MAX in one pass, save "
+    "the cost of each and make the template with the suggested # (greedy and pam "
+    "only)",
+)
 ap.add_argument("-w", "--width", type=int, help="width of output template in pixels")
 ap.add_argument("-hi", "--height", type=int, help="height of output template in pixels")
 ap.add_argument(
-    "-m", "--method", type=str, choices=["greedy", "pulp", "mpr"], default="greedy"
+    "-m",
+    "--method",
+    type=str,
+    choices=["greedy", "pam", "pulp", "mpr"],
+    default="greedy",
+)
+ap.add_argument(
+    "-o",
+    "--order",
+    type=str,
+    choices=["seen", "count", "palette"],
+    default="seen",
+    help="how to number the colors in the template and stats",
+)
+ap.add_argument(
+    "--metric",
+    type=str,
+    choices=list(METRICS),
+    default="lab",
+    help="how to measure the difference between colors: squared L*A*B* distance "
+    "(the default), ciede2000 (closest to how different yarns look, but slowest), "
+    "or another of the choices",
+)
+ap.add_argument(
+    "-s",
+    "--shortlist",
+    type=int,
+    help="choose this many candidate colors on a shrunk image first, then only "
+    "search among them (greedy, pam and pulp; pulp uses 24 by default)",
+)
+ap.add_argument(
+    "--max-groups",
+    type=int,
+    help="merge the template's distinct colors into at most this many groups of "
+    "similar colors for the solver (pulp only, 400 by default)",
+)
+ap.add_argument(
+    "-t",
+    "--threads",
+    type=int,
+    default=1,
+    help="threads to quantize the full size image with (mpr only)",
+)
+ap.add_argument(
+    "--time-limit",
+    type=float,
+    help="seconds the solver may take, building its problem included; it's stopped "
+    "then and the best selection so far is used (pulp only)",
+)
+ap.add_argument(
+    "--gap-limit",
+    type=float,
+    help="relative optimality gap at which the solver may stop (pulp only)",
+)
+ap.add_argument(
+    "--deadline",
+    type=float,
+    help="seconds after which to stop searching and use the best colors so far",
+)
+ap.add_argument(
+    "--table-dir",
+    type=str,
+    help="directory to cache the palette's closest color lookup table in (mpr only)",
+)
+ap.add_argument(
+    "--cache-dir",
+    type=str,
+    help="directory to cache chosen colors and intermediate results in",
+)
+ap.add_argument(
+    "--cache-size",
+    type=int,
+    default=1024,
+    help="size in MiB past which the least recently used cache entries are removed",
+)
+ap.add_argument(
+    "-p",
+    "--pattern",
+    type=str,
+    choices=["npz", "json"],
+    help="also save the template as a compact grid of color numbers plus the "
+    "colors' names and counts, in this format",
+)
+ap.add_argument(
+    "--no-images",
+    action="store_true",
+    help="don't render and write the template images",
+)
+ap.add_argument(
+    "--pages",
+    type=int,
+    nargs=2,
+    metavar=("ROWS", "COLUMNS"),
+    help="also write the template as printable pages of this many squares",
+)
+ap.add_argument(
+    "--page-overlap",
+    type=int,
+    default=2,
+    help="rows and columns repeated on neighboring pages (with --pages)",
+)
+ap.add_argument(
+    "-v",
+    "--verbose",
+    action="store_true",
+    help="print progress, solver messages and how long each stage takes",
+)
+ap.add_argument(
+    "--log",
+    type=str,
+    help="path to append a JSON line per stage timing and progress event to",
+)
+ap.add_argument(
+    "--profile",
+    type=str,
+    help="path to write cProfile statistics of choosing the colors to (one file "
+    "per process with --batch)",
+)
+ap.add_argument(
+    "--trace-memory",
+    action="store_true",
+    help="record each stage's peak memory use in the log (slows things down)",
 )
 ap.add_argument(
     "-",
@@ -27,23 +183,247 @@ ap.add_argument(
     default="color_names.json",
 )
 
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+OUTPUT_SUFFIXES = (
+    "_chosen_colors_no_grid.png",
+    "_chosen_colors.png",
+    "_stats_img.png",
+    "_resized_img.png",
+)
+OUTPUT_PAGE = re.compile(r"_page_\d+_\d+\.png$")
 
-if __name__ == "__main__":
-    args = ap.parse_args()
+# the chooser used by this process, set up once by init_chooser()
+chooser = None
+# in a batch worker, where it reports each image it starts (see init_batch_worker())
+started_images = None
+
+
+def init_chooser(args):
+    """
+    Load the palette and create the chooser for this process. Run once per worker
+    so that the palette is only read and converted once per process.
+    """
+    global chooser
 
     with open(args.color_options) as f:
         color_options = {name: np.array(color) for name, color in json.load(f).items()}
 
+    options = {"instrumentation": init_instrumentation(args), "metric": args.metric}
+    if args.cache_dir is not None:
+        options["cache"] = ResultCache(args.cache_dir, args.cache_size * 2**20)
+
     if args.method == "greedy":
-        chooser = GreedyChooser(color_options)
+        chooser = GreedyChooser(color_options, shortlist_size=args.shortlist, **options)
+    elif args.method == "pam":
+        chooser = PamChooser(color_options, shortlist_size=args.shortlist, **options)
     elif args.method == "pulp":
-        chooser = PulpChooser(color_options)
+        # the solver's problem is bounded by default, so only pass the bounds given
+        if args.shortlist is not None:
+            options["shortlist_size"] = args.shortlist
+        if args.max_groups is not None:
+            options["max_groups"] = args.max_groups
+        chooser = PulpChooser(
+            color_options,
+            time_limit=args.time_limit,
+            gap_limit=args.gap_limit,
+            **options,
+        )
     elif args.method == "mpr":
-        chooser = MaxPoolResizeChooser(color_options)
+        chooser = MaxPoolResizeChooser(
+            color_options, threads=args.threads, table_dir=args.table_dir, **options
+        )
+
+
+def init_batch_worker(args, started):
+    """
+    init_chooser() for a batch worker, which also puts each image it starts on the
+    started queue, so that the image can be found if the worker dies.
+    """
+    global started_images
+
+    started_images = started
+    init_chooser(args)
+
+
+def init_instrumentation(args):
+    """
+    Returns the Instrumentation for the sinks asked for on the command line.
+    """
+    sinks = []
+    if args.verbose:
+        sinks.append(TextSink())
+    if args.log is not None:
+        sinks.append(JsonLogSink(args.log))
+    if args.profile is not None:
+        path = args.profile
+        if args.batch is not None:
+            path = f"{path}.{os.getpid()}"
+        sinks.append(ProfileSink(path))
+    if args.trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return Instrumentation(sinks)
+
+
+def process_image(image_path, args):
+    """
+    Make the template for one image and write the output images next to it.
+    """
+    # decoded only as large as the template needs, so the template size is worked
+    # out here from the image's full size
+    img, (width, height) = load_image(image_path, chooser, args.width, args.height)
+    if img is None:
+        raise ValueError(f"could not read image {image_path}")
+    img_name = os.path.splitext(image_path)[0]
+
+    chooser.instrumentation.message(f"processing {image_path}", image=image_path)
+    clusters = args.clusters
+    if args.sweep is not None:
+        sweep = chooser.sweep_colors(img, *args.sweep, width, height)
+        with open(img_name + "_sweep.json", "w") as f:
+            json.dump(sweep, f, indent=2)
+        for k, cost in zip(sweep["clusters"], sweep["costs"]):
+            print(f"{image_path}: {k} colors, cost {cost:.0f}")
+        print(f"{image_path}: suggested # of colors: {sweep['knee']}")
+        clusters = sweep["knee"]
+    pattern = chooser.choose_colors(
+        img, clusters, width, height, args.order, args.deadline
+    )
+    if not pattern.finished:
+        print(f"{image_path}: stopped at the deadline, cost {pattern.cost:.0f}")
+    if args.pattern is not None:
+        pattern.save(f"{img_name}_pattern.{args.pattern}")
+    if not args.no_images:
+        for name in chooser.output_images:
+            if name == "chosen_colors.png":
+                # the grid image can be huge, so write it a strip at a time rather
+                # than rendering it whole
+                with chooser.instrumentation.span("render"):
+                    pattern.save_grid_image(img_name + "_" + name)
+            else:
+                cv2.imwrite(img_name + "_" + name, chooser.output_images[name])
+    if args.pages is not None:
+        with chooser.instrumentation.span("pages"):
+            pattern.save_pages(img_name + "_page", *args.pages, args.page_overlap)
+
+
+def process_batch_image(image_path, args):
+    """
+    Run process_image() in a worker, returning the time it took and the error, if
+    any, instead of raising so that one bad image doesn't stop the batch.
+    """
+    if started_images is not None:
+        started_images.put(image_path)
+    start = time.perf_counter()
+    try:
+        process_image(image_path, args)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return image_path, time.perf_counter() - start, error
+
+
+def find_images(batch):
+    """
+    Given a directory, manifest file or glob pattern, return the image paths to
+    process. Images in a directory are filtered by extension and skip the outputs
+    of earlier runs.
+    """
+    if os.path.isdir(batch):
+        return sorted(
+            os.path.join(batch, f)
+            for f in os.listdir(batch)
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS
+            and not f.endswith(OUTPUT_SUFFIXES)
+            and not OUTPUT_PAGE.search(f)
+        )
+    elif os.path.isfile(batch):
+        with open(batch) as f:
+            return [line.strip() for line in f if line.strip()]
+    return sorted(glob.glob(batch))
+
+
+def run_batch(args):
+    """
+    Process every image in args.batch on a pool of worker processes, printing the
+    time or error for each one as it finishes. Returns the number of failures.
+
+    If a worker dies, e.g. killed for running out of memory, the pool is broken and
+    every unfinished image fails with it. The image the worker was running is
+    reported as failed, and the rest are run again on a new pool. If several
+    images were running, which of them killed its worker isn't known, so they're
+    run again one at a time first.
+    """
+    image_paths = find_images(args.batch)
+    failures = 0
+    start = time.perf_counter()
+    # (images, workers) to run on a pool each, in order
+    rounds = [(image_paths, args.workers)]
+    while rounds:
+        paths, workers = rounds.pop(0)
+        if not paths:
+            continue
+        started = multiprocessing.SimpleQueue()
+        finished = set()
+        broken = False
+        with ProcessPoolExecutor(
+            workers, initializer=init_batch_worker, initargs=(args, started)
+        ) as executor:
+            futures = [
+                executor.submit(process_batch_image, image_path, args)
+                for image_path in paths
+            ]
+            for future in as_completed(futures):
+                try:
+                    image_path, seconds, error = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    continue
+                finished.add(image_path)
+                if error is None:
+                    print(f"{image_path}: done in {seconds:.2f}s")
+                else:
+                    failures += 1
+                    print(f"{image_path}: failed after {seconds:.2f}s: {error}")
+        if not broken:
+            continue
+
+        running = set()
+        while not started.empty():
+            running.add(started.get())
+        running -= finished
+        unfinished = [image_path for image_path in paths if image_path not in finished]
+        if len(running) == 1:
+            failed_path = running.pop()
+            failures += 1
+            print(f"{failed_path}: failed, its worker process died")
+            rounds.insert(0, ([p for p in unfinished if p != failed_path], workers))
+        elif running:
+            rounds[:0] = [
+                ([p for p in unfinished if p in running], 1),
+                ([p for p in unfinished if p not in running], workers),
+            ]
+        else:
+            # the worker died before starting an image, e.g. while loading the
+            # palette, so running the images again won't help
+            for image_path in unfinished:
+                failures += 1
+                print(f"{image_path}: not processed, a worker process died")
+    print(
+        f"processed {len(image_paths)} images in {time.perf_counter() - start:.2f}s, "
+        f"{failures} failed"
+    )
+    return failures
+
+
+if __name__ == "__main__":
+    args = ap.parse_args()
+    if args.clusters is None and args.sweep is None:
+        ap.error("one of -c/--clusters or --sweep is required")
+    if args.sweep is not None and args.method not in ("greedy", "pam"):
+        ap.error("--sweep only works with the greedy and pam methods")
 
-    img = cv2.imread(args.image)
-    img_name = os.path.splitext(args.image)[0]
+    if args.batch is not None:
+        raise SystemExit(1 if run_batch(args) else 0)
 
-    chooser.choose_colors(img, args.clusters, args.width, args.height)
-    for name, image in chooser.output_images.items():
-        cv2.imwrite(img_name + "_" + name, image)
+    init_chooser(args)
+    process_image(args.image, args)
@@ -1,24 +1,214 @@
+import hashlib
+
 import cv2
 import numpy as np
 
+from instrumentation import Instrumentation
+from palette import Palette
+from pattern import LazyImages, Pattern, render_grid
+from utils import Deadline, compress_colors, pack_colors, unpack_colors
+
 
 class ColorChooser:
-    def __init__(self, color_options):
-        self.output_images = {}
+    """
+    Base class for the color choosing methods, which implement choose_colors_body().
+    If a ResultCache is given, chosen colors are cached by image, palette, method,
+    settings, clusters and size, and subclasses can cache intermediate results that
+    don't depend on clusters with cached(). SETTINGS names the attributes of a
+    subclass which change its results. Timings and progress are reported through
+    an Instrumentation, if one is given. Subclasses' searches should stop with the
+    best result so far once self.deadline passes (see Deadline). Choosers which
+    look at every pixel of the original image set FULL_RESOLUTION, so image_loader
+    doesn't decode a smaller copy of it for them. metric picks how colors are
+    compared, from metrics.METRICS.
+    """
+
+    SETTINGS = ()
+    FULL_RESOLUTION = False
+
+    def __init__(
+        self,
+        color_options,
+        dtype=np.int32,
+        table_dir=None,
+        cache=None,
+        instrumentation=None,
+        metric="lab",
+    ):
+        self.output_images = LazyImages()
+        self.pattern = None
         self.color_options = color_options
+        self.palette = Palette(color_options, dtype, table_dir, metric)
+        self.cache = cache
+        # results of cached() during a choose_colors() call
+        self.memo = None
+        self.deadline = None
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
 
-    def choose_colors_body(self, img, clusters, width, height):
+    def choose_colors_body(self, img, clusters, width, height, image_hash=None):
         pass
 
-    def choose_colors(self, img, clusters, arg_width, arg_height):
+    def choose_colors(
+        self, img, clusters, arg_width, arg_height, order="seen", deadline=None
+    ):
+        """
+        Chooses the colors for a template of img and returns it as a Pattern (see
+        get_dimentions() for the size and Pattern.from_image() for the order). The
+        template's images are also put in output_images, each rendered the first
+        time it's used.
+
+        If deadline is given, the search for colors stops with the best selection
+        found so far after that many seconds (resizing, quantizing and rendering
+        aren't cut short). The Pattern's finished says whether the search was done
+        in time, and its cost is the total difference between the resized image and
+        the template, measured with the palette's metric.
+        """
+        self.output_images = LazyImages()
+        self.memo = {}
         width, height = self.get_dimentions(img, arg_width, arg_height)
-        result_img = self.choose_colors_body(img, clusters, width, height)
-        self.output_images["chosen_colors_no_grid.png"] = result_img
-        stats_img, color_order = self.make_color_stats(result_img)
-        self.output_images["stats_img.png"] = stats_img
-        self.output_images["chosen_colors.png"] = self.add_lines_and_symbols(
-            result_img, color_order
-        )
+        if deadline is not None:
+            self.deadline = Deadline(deadline)
+        try:
+            with self.instrumentation.span(
+                "choose_colors",
+                method=type(self).__name__,
+                clusters=clusters,
+                width=width,
+                height=height,
+            ):
+                return self.choose_colors_stages(img, clusters, width, height, order)
+        finally:
+            self.deadline = None
+            self.memo = None
+
+    def choose_colors_stages(self, img, clusters, width, height, order):
+        image_hash = self.hash_image(img)
+        if self.cache is None:
+            result_img = self.choose_colors_body(img, clusters, width, height)
+        else:
+            key = self.cache.key(
+                "result",
+                image_hash,
+                img.shape,
+                self.palette.hash(),
+                type(self).__name__,
+                [getattr(self, name) for name in self.SETTINGS],
+                clusters,
+                width,
+                height,
+            )
+            cached = self.cache.get(key)
+            if cached is None:
+                self.instrumentation.message("no cached result")
+                result_img = self.choose_colors_body(
+                    img, clusters, width, height, image_hash
+                )
+                indices = self.palette.find_indices(result_img)
+                # a selection cut short by the deadline isn't the method's result
+                if self.deadline is None or not self.deadline.hit:
+                    self.cache.put(key, {"indices": indices})
+            else:
+                self.instrumentation.message("using cached result")
+                result_img = self.palette.lookup(cached["indices"])
+        with self.instrumentation.span("pattern"):
+            self.pattern = Pattern.from_image(result_img, self.palette, order)
+            self.pattern.cost = self.template_cost(
+                img, result_img, width, height, image_hash
+            )
+            self.pattern.finished = self.deadline is None or not self.deadline.hit
+        if not self.pattern.finished:
+            self.instrumentation.message("stopped at the deadline")
+        self.output_images.update(self.pattern.renderers(self.instrumentation))
+        return self.pattern
+
+    def hash_image(self, img):
+        """
+        Returns the hash of img which keys its cache entries, or None if there's no
+        cache to key.
+        """
+        if self.cache is None:
+            return None
+        return hashlib.sha1(img.tobytes()).hexdigest()
+
+    def cached(self, name, img, width, height, compute, image_hash=None):
+        """
+        Returns the dict of arrays compute() returns, cached under name for img at
+        the given size if there is a cache. image_hash is img's hash_image(), which
+        callers that already have it can pass to save hashing img again. Within one
+        choose_colors() call the arrays are also kept in memory, so they're only
+        computed or loaded once.
+        """
+        if self.memo is not None and (name, width, height) in self.memo:
+            return self.memo[name, width, height]
+        if self.cache is None:
+            arrays = compute()
+        else:
+            if image_hash is None:
+                image_hash = self.hash_image(img)
+            key = self.cache.key(
+                name,
+                image_hash,
+                img.shape,
+                self.palette.hash(),
+                str(self.palette.dtype),
+                width,
+                height,
+            )
+            arrays = self.cache.get(key)
+            if arrays is None:
+                arrays = compute()
+                self.cache.put(key, arrays)
+        if self.memo is not None:
+            self.memo[name, width, height] = arrays
+        return arrays
+
+    def template_cost(self, img, result_img, width, height, image_hash=None):
+        """
+        Returns the total difference, by the palette's metric, between img resized
+        to the template's size and the template result_img, which the choosers
+        minimize.
+        """
+        prepared = self.get_differences(img, width, height, image_hash)
+        indices = self.palette.find_indices(result_img)
+        differences = prepared["differences"][prepared["inverse"], indices]
+        return float(np.sum(differences, dtype=np.float64))
+
+    def get_differences(self, img, width, height, image_hash=None):
+        """
+        Resizes img to the template size and collapses it to its distinct colors.
+        Returns a dict of the resized image, the distinct colors' (n_unique, n_colors)
+        differences to the palette, their pixel counts, and the inverse map from
+        the template back to the distinct colors. See compress_colors().
+        """
+
+        def compute():
+            resized_img = self.resize(img, width, height)
+            unique_colors, counts, inverse = compress_colors(resized_img)
+            return {
+                "resized_img": resized_img,
+                "unique_colors": unique_colors,
+                "differences": self.color_differences(unique_colors)[:, 0, :],
+                "counts": counts,
+                "inverse": inverse,
+            }
+
+        return self.cached("differences", img, width, height, compute, image_hash)
+
+    def resize(self, img, width, height):
+        with self.instrumentation.span("resize"):
+            return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+    def color_differences(self, img, colors=None):
+        """
+        get_color_differences() for this chooser's palette, reporting the L*A*B*
+        conversion and the differences as separate spans.
+        """
+        with self.instrumentation.span("lab"):
+            lab_img = self.palette.to_lab(img)
+        with self.instrumentation.span("differences"):
+            return self.palette.lab_differences(lab_img, colors)
 
     def get_dimentions(self, img, width, height):
         """
@@ -44,168 +234,30 @@ class ColorChooser:
 
         return (int(cols / ratio), int(rows / ratio))
 
-    def add_lines_and_symbols(self, img, color_order):
+    def add_lines_and_symbols(self, img, color_order, square_width=20):
         """
         Makes an expanded version of the final template, where each pixel is outlined with a
         black box and every 10 pixels there is a light blue line (the same as which shows up
         on the latch hook canvas). Also puts symbols (numbers) in each box corresponding to
-        the numbers in the stats image.
+        the numbers in the stats image. See render_grid().
         """
-        square_width = 20
-        rows, cols = img.shape[:2]
-        new_img = cv2.resize(img, (cols * square_width, rows * square_width))
-        for i in range(0, cols):
-            for j in range(0, rows):
-                pixel = img[j, i]
-                for ii in range(0, square_width - 2):
-                    for jj in range(0, square_width - 2):
-                        new_img[j * square_width + jj, i * square_width + ii] = pixel
-                if i % 10 == 9 and i > 0:
-                    cv2.line(
-                        new_img,
-                        (i * square_width + square_width - 1, j * square_width),
-                        (
-                            i * square_width + square_width - 1,
-                            j * square_width + square_width - 1,
-                        ),
-                        (255, 204, 51),
-                        2,
-                    )
-                else:
-                    cv2.line(
-                        new_img,
-                        (i * square_width + square_width - 1, j * square_width),
-                        (
-                            i * square_width + square_width - 1,
-                            j * square_width + square_width - 1,
-                        ),
-                        (0, 0, 0),
-                        2,
-                    )
-                if (j - rows) % 10 == 9 and j > 0:
-                    cv2.line(
-                        new_img,
-                        (i * square_width, j * square_width + square_width - 1),
-                        (
-                            i * square_width + square_width - 1,
-                            j * square_width + square_width - 1,
-                        ),
-                        (255, 204, 51),
-                        2,
-                    )
-                else:
-                    cv2.line(
-                        new_img,
-                        (i * square_width, j * square_width + square_width - 1),
-                        (
-                            i * square_width + square_width - 1,
-                            j * square_width + square_width - 1,
-                        ),
-                        (0, 0, 0),
-                        2,
-                    )
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                pixelStr = "%.2x%.2x%.2x" % (pixel[2], pixel[1], pixel[0])
-                number_color = (0, 0, 0)
-                if max(pixel) < 175:
-                    number_color = (255, 255, 255)
-                if color_order[pixelStr] < 10:
-                    cv2.putText(
-                        new_img,
-                        str(color_order[pixelStr]),
-                        (i * square_width + 6, j * square_width + 12),
-                        font,
-                        0.3,
-                        number_color,
-                        1,
-                        cv2.LINE_AA,
-                    )
-                else:
-                    cv2.putText(
-                        new_img,
-                        str(color_order[pixelStr]),
-                        (i * square_width + 2, j * square_width + 12),
-                        font,
-                        0.3,
-                        number_color,
-                        1,
-                        cv2.LINE_AA,
-                    )
-
-        return new_img
-
-    def make_color_stats(self, img):
+        keys, inverse = np.unique(pack_colors(img), return_inverse=True)
+        symbols = np.array([color_order[key] for key in keys.tolist()])
+        colors = np.zeros((max(color_order.values()) + 1, 3), np.uint8)
+        colors[symbols] = unpack_colors(keys)
+        return render_grid(
+            symbols[inverse.reshape(img.shape[:2])], colors, square_width
+        )
+
+    def make_color_stats(self, img, order="seen"):
         """
         Given a final template image, calculates how many of each color are in the
         image (aka how much of each string color is needed). Returns an image that
-        contains these numbers.
+        contains these numbers, and a dict from packed color (see pack_colors()) to
+        its number. See Pattern.from_image() for the orders.
         """
-        color_names = dict(
-            ("%.2x%.2x%.2x" % (int(v[2]), int(v[1]), int(v[0])), k)
-            for k, v in self.color_options.items()
-        )
-        colors = {}
-        rows, cols = img.shape[:2]
-        width = 20
-
-        for i in range(0, cols):
-            for j in range(0, rows):
-                pixel = img[j, i]
-                color = "%.2x%.2x%.2x" % (pixel[2], pixel[1], pixel[0])
-                if color in colors:
-                    colors[color] += 1
-                else:
-                    colors[color] = 1
-
-        stats_img = np.ones((len(colors) * width, 250, 3), dtype=np.uint8) * 255
-        color_order = {}
-        i = 0
-        for color, num_strings in colors.items():
-            color_order[color] = i
-            stats_img[i * width + 2 : i * width + 19, 2:19] = [
-                [[int(color[4:6], 16), int(color[2:4], 16), int(color[0:2], 16)]] * 17
-            ] * 17
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            number_color = (0, 0, 0)
-            if max(int(color[4:6], 16), int(color[2:4], 16), int(color[0:2], 16)) < 175:
-                number_color = (255, 255, 255)
-            if i >= 10:
-                cv2.putText(
-                    stats_img,
-                    str(i),
-                    (3, i * width + 15),
-                    font,
-                    0.3,
-                    number_color,
-                    1,
-                    cv2.LINE_AA,
-                )
-            else:
-                cv2.putText(
-                    stats_img,
-                    str(i),
-                    (7, i * width + 15),
-                    font,
-                    0.3,
-                    number_color,
-                    1,
-                    cv2.LINE_AA,
-                )
-            cv2.putText(
-                stats_img,
-                color_names[color]
-                + " "
-                + str(num_strings)
-                + " strings, "
-                + str(round(num_strings * 2.44 / (12 * 3), 1))
-                + " yards",
-                (25, i * width + 13),
-                font,
-                0.3,
-                (0, 0, 0),
-                1,
-                cv2.LINE_AA,
-            )
-            i += 1
-
-        return stats_img, color_order
+        pattern = Pattern.from_image(img, self.palette, order)
+        color_order = {
+            key: i for i, key in enumerate(pack_colors(pattern.colors).tolist())
+        }
+        return pattern.stats_image(), color_order
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
+import argparse
+import hashlib
 import json
 import os
-import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -10,6 +12,41 @@ import numpy as np
 # to get source images: go to main website and save-as, which will
 # download a resources folder containing all images
 # remove duplicates with find <dir> -regex ".*(1)\.jpg" -print0 | xargs -0 rm
+#
+# each swatch is only read again when it changes: a manifest next to each output
+# file records every swatch's mtime, size, hash and color, and the colors are
+# merged into the existing output rather than rebuilding it. Several vendors'
+# palettes can be refreshed at once:
+#
+#   python get_color_options.py vendor_a/ a_colors.json vendor_b/ b_colors.json
+
+ap = argparse.ArgumentParser()
+ap.add_argument(
+    "palettes",
+    nargs="+",
+    metavar="DIRECTORY OUTPUT",
+    help="pairs of a directory of swatch images and the JSON file of colors to "
+    "merge them into",
+)
+ap.add_argument(
+    "-j",
+    "--workers",
+    type=int,
+    default=os.cpu_count(),
+    help="number of threads reading swatches",
+)
+ap.add_argument(
+    "--prefix-length",
+    type=int,
+    default=8,
+    help="number of characters at the start of swatch file names to leave out of "
+    "the color names",
+)
+ap.add_argument(
+    "--full",
+    action="store_true",
+    help="read every swatch again rather than reusing the manifest's colors",
+)
 
 
 def chooseColor(img):
@@ -19,15 +56,108 @@ def chooseColor(img):
     return np.median(np.median(cropped_img, axis=0), axis=0)
 
 
-if __name__ == "__main__":
-    directory = sys.argv[1]
-    colors = {}
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def find_swatches(directory):
+    """
+    Returns the paths of the swatch images under directory, relative to it.
+    """
+    swatches = []
     for subdir, dirs, files in os.walk(directory):
         for f in files:
-            filename, ext = os.path.splitext(f)
-            if ext == ".jpg":
-                img = cv2.imread(os.path.join(subdir, f))
-                colors[filename[8:]] = chooseColor(img).astype("uint8").tolist()
-    print(f"Colors: {colors}\n\nSaving to {sys.argv[2]}")
-    with open(sys.argv[2], "w") as f:
-        json.dump(colors, f)
+            if os.path.splitext(f)[1] == ".jpg":
+                swatches.append(os.path.relpath(os.path.join(subdir, f), directory))
+    return sorted(swatches)
+
+
+def read_swatch(directory, swatch, known, prefix_length):
+    """
+    Returns the manifest entry for a swatch, reusing the known entry if the file is
+    unchanged: first by mtime and size, then by hash in case it was only touched.
+    """
+    path = os.path.join(directory, swatch)
+    stat = os.stat(path)
+    entry = {"mtime": stat.st_mtime, "size": stat.st_size}
+    if known is not None and all(known[key] == entry[key] for key in entry):
+        return known
+    entry["sha1"] = file_hash(path)
+    if known is not None and known["sha1"] == entry["sha1"]:
+        return {**known, **entry}
+
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError(f"could not read swatch {path}")
+    name = os.path.splitext(os.path.basename(swatch))[0][prefix_length:]
+    return {**entry, "name": name, "color": chooseColor(img).astype("uint8").tolist()}
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, value):
+    # write under a temporary name first so an interrupted run can't leave a
+    # truncated palette behind
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(temp_path, path)
+
+
+def update_palette(directory, output, executor, prefix_length, full=False):
+    """
+    Reads the new and changed swatches in directory and merges their colors into
+    the JSON file of colors at output, dropping the colors of swatches which were
+    deleted. Colors in output which didn't come from a swatch are kept.
+    """
+    manifest_path = output + ".manifest.json"
+    manifest = load_json(manifest_path, {})
+    colors = load_json(output, {})
+
+    swatches = find_swatches(directory)
+    # a full run reads every swatch again, but still needs the old manifest to
+    # find the swatches which were deleted
+    entries = executor.map(
+        lambda swatch: read_swatch(
+            directory, swatch, None if full else manifest.get(swatch), prefix_length
+        ),
+        swatches,
+    )
+    new_manifest = dict(zip(swatches, entries))
+
+    removed = [
+        entry["name"]
+        for swatch, entry in manifest.items()
+        if swatch not in new_manifest
+    ]
+    for name in removed:
+        colors.pop(name, None)
+    changed = 0
+    for entry in new_manifest.values():
+        if colors.get(entry["name"]) != entry["color"]:
+            colors[entry["name"]] = entry["color"]
+            changed += 1
+
+    write_json(output, colors)
+    write_json(manifest_path, new_manifest)
+    print(
+        f"{directory}: {len(swatches)} swatches, {changed} colors added or changed, "
+        f"{len(removed)} removed; saved {len(colors)} colors to {output}"
+    )
+
+
+if __name__ == "__main__":
+    args = ap.parse_args()
+    if len(args.palettes) % 2 != 0:
+        ap.error("palettes must be given as pairs of DIRECTORY OUTPUT")
+
+    # cv2 releases the GIL while decoding, so threads read swatches in parallel
+    with ThreadPoolExecutor(args.workers) as executor:
+        for directory, output in zip(args.palettes[::2], args.palettes[1::2]):
+            update_palette(directory, output, executor, args.prefix_length, args.full)
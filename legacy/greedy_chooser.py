@@ -2,48 +2,188 @@ import cv2
 import numpy as np
 
 from color_chooser import ColorChooser
-from utils import get_color_differences, get_full_color_regions, calculate_total_cost
+from utils import calculate_swap_costs, compress_colors, find_knee, get_nearest_two
 
 
-class GreedyChooser(ColorChooser):
-    def choose_colors_body(self, img, clusters, width, height):
-        resized_img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
-        self.output_images["resized_img.png"] = resized_img
-        best_selected_colors = np.hstack(
-            (
-                np.ones(clusters, dtype=np.float64),
-                np.full(len(self.color_options) - clusters, np.nan, dtype=np.float64),
+def greedy_selection(differences, counts, clusters, progress=None, deadline=None):
+    """
+    Given the (n_unique, n_colors) differences of each distinct color to every palette
+    color and how many pixels have each distinct color, greedily choose clusters
+    palette colors. Starts from the first clusters colors and tries each later color
+    in place of each chosen one, keeping the best swap if it lowers the total cost.
+    Returns the sorted selected indices, the closest selected color per distinct
+    color, and the total cost. If given, progress is called with the iteration and
+    the total cost so far after trying each color, and the search stops early with
+    the best selection so far once the Deadline deadline passes.
+    """
+    n_colors = differences.shape[1]
+    return greedy_swaps(
+        differences,
+        counts,
+        np.arange(min(clusters, n_colors)),
+        range(clusters + 1, n_colors),
+        progress,
+        deadline,
+    )
+
+
+def greedy_swaps(
+    differences, counts, selected_colors, candidates, progress=None, deadline=None
+):
+    """
+    The search of greedy_selection() from the given sorted selection, trying each
+    of candidates in turn in place of each selected color.
+    """
+    n_colors = differences.shape[1]
+    best_selected_colors = np.asarray(selected_colors)
+    nearest, best, second = get_nearest_two(differences, best_selected_colors)
+    best_cost = np.sum(best * counts, dtype=np.float64)
+    for iteration, i in enumerate(candidates):
+        if deadline is not None and deadline.passed():
+            break
+        # for each currently chosen color, the cost of replacing it with color i
+        costs = calculate_swap_costs(
+            differences[:, i], nearest, best, second, n_colors, counts
+        )[best_selected_colors]
+        j = np.argmin(costs)
+        if costs[j] < best_cost:
+            best_cost = costs[j]
+            best_selected_colors = np.sort(
+                np.append(np.delete(best_selected_colors, j), i)
             )
+            nearest, best, second = get_nearest_two(differences, best_selected_colors)
+        if progress is not None:
+            progress(iteration, best_cost)
+    return best_selected_colors, nearest, best_cost
+
+
+def add_best_color(differences, counts, selected_colors):
+    """
+    Returns the sorted selection with the unselected color added which lowers the
+    total cost the most.
+    """
+    candidates = np.setdiff1d(np.arange(differences.shape[1]), selected_colors)
+    best = np.min(differences[:, selected_colors], axis=1, keepdims=True)
+    costs = np.sum(
+        np.minimum(differences[:, candidates], best) * counts.reshape(-1, 1),
+        axis=0,
+        dtype=np.float64,
+    )
+    return np.sort(np.append(selected_colors, candidates[np.argmin(costs)]))
+
+
+class GreedyChooser(ColorChooser):
+    """
+    Chooses colors with greedy_selection(). If shortlist_size is given, colors are
+    first chosen coarse to fine: a selection of shortlist_size colors is made on a
+    copy of the template shrunk to at most COARSE_SIZE pixels on its long side, and
+    the final selection is only searched for among those colors.
+    """
+
+    COARSE_SIZE = 32
+    SETTINGS = ("shortlist_size",)
+
+    def __init__(self, color_options, shortlist_size=None, **kwargs):
+        super().__init__(color_options, **kwargs)
+        self.shortlist_size = shortlist_size
+
+    def select_colors(self, differences, counts, clusters):
+        progress = self.instrumentation.progress_callback(
+            "greedy", max(0, differences.shape[1] - clusters - 1)
         )
-        rows, cols = resized_img.shape[:2]
-        full_color_regions = get_full_color_regions(cols, rows, self.color_options)
-        differences = get_color_differences(resized_img, full_color_regions)
-        best_cost = calculate_total_cost(differences, best_selected_colors)
-        for i in range(clusters + 1, len(self.color_options)):
-            new_selection_options = []
-            for j in range(len(best_selected_colors)):
-                if best_selected_colors[j] == 1:
-                    new_selection = best_selected_colors.copy()
-                    new_selection[j] = np.nan
-                    new_selection[i] = 1
-                    new_selection_options.append(new_selection)
-            # for each currently chosen color, try replacing it with color i
-            for new_selection_option in new_selection_options:
-                cost = calculate_total_cost(differences, new_selection_option)
-                if cost < best_cost:
-                    best_cost = cost
-                    best_selected_colors = new_selection_option
-
-        # get the min difference, aka the closest color match, for each pixel in the image
-        min_indices = np.nanargmin(
-            np.multiply(
-                differences, best_selected_colors.reshape(np.array([1, 1, -1]))
-            ),
-            axis=2,
+        return greedy_selection(differences, counts, clusters, progress, self.deadline)
+
+    def refine_colors(self, differences, counts, selected_colors):
+        """
+        Improves a selection made by adding a color to a smaller selection, as
+        sweep_colors() does, returning the same values as select_colors().
+        """
+        candidates = np.setdiff1d(np.arange(differences.shape[1]), selected_colors)
+        return greedy_swaps(
+            differences, counts, selected_colors, candidates, deadline=self.deadline
         )
-        x, y = np.indices(min_indices.shape)
 
-        # the new image becomes the best match for each pixel
-        ret_img = full_color_regions[x, y, :, min_indices]
+    def sweep_colors(self, img, min_clusters, max_clusters, arg_width, arg_height):
+        """
+        Chooses colors for every number of clusters from min_clusters to max_clusters
+        in one pass over the template's differences: min_clusters are chosen as by
+        choose_colors(), and each larger selection starts from the one before plus
+        the color which helps most, then is improved with refine_colors(). Returns a
+        dict of the "clusters", the total "costs" and the "selected" palette color
+        names for each, and the "knee" of the cost curve (see find_knee()) as a
+        suggested number of colors.
+        """
+        width, height = self.get_dimentions(img, arg_width, arg_height)
+        prepared = self.get_differences(img, width, height)
+        differences, counts = prepared["differences"], prepared["counts"]
+        max_clusters = min(max_clusters, len(self.palette))
 
-        return ret_img
+        clusters = list(range(min_clusters, max_clusters + 1))
+        costs, selections = [], []
+        with self.instrumentation.span("sweep"):
+            for k in clusters:
+                if not selections:
+                    selected_colors, _, cost = self.select_colors(
+                        differences, counts, k
+                    )
+                else:
+                    selected_colors, _, cost = self.refine_colors(
+                        differences,
+                        counts,
+                        add_best_color(differences, counts, selections[-1]),
+                    )
+                costs.append(float(cost))
+                selections.append(selected_colors)
+                self.instrumentation.progress(
+                    "sweep", k - min_clusters, len(clusters), cost=cost
+                )
+        return {
+            "clusters": clusters,
+            "costs": costs,
+            "selected": [
+                [self.palette.names[c] for c in selected_colors]
+                for selected_colors in selections
+            ],
+            "knee": find_knee(clusters, costs),
+        }
+
+    def choose_colors_body(self, img, clusters, width, height, image_hash=None):
+        if self.shortlist_size is None:
+            # work on each distinct color once, weighted by how many pixels have it
+            prepared = self.get_differences(img, width, height, image_hash)
+            resized_img, differences, counts, inverse = (
+                prepared[name]
+                for name in ("resized_img", "differences", "counts", "inverse")
+            )
+            candidates = np.arange(len(self.palette))
+        else:
+            resized_img = self.resize(img, width, height)
+            with self.instrumentation.span("shortlist"):
+                candidates = self.shortlist_colors(resized_img, clusters)
+            unique_colors, counts, inverse = compress_colors(resized_img)
+            differences = self.color_differences(unique_colors, candidates)[:, 0, :]
+        self.output_images["resized_img.png"] = resized_img
+        with self.instrumentation.span("selection"):
+            _, nearest, _ = self.select_colors(differences, counts, clusters)
+
+        # the new image becomes the closest selected color for each pixel
+        with self.instrumentation.span("assignment"):
+            return self.palette.lookup(candidates[nearest][inverse])
+
+    def shortlist_colors(self, img, clusters):
+        """
+        Returns the sorted palette indices of the colors selected for a shrunk copy
+        of img, choosing at least clusters and at most shortlist_size of them.
+        """
+        rows, cols = img.shape[:2]
+        scale = min(1, self.COARSE_SIZE / max(rows, cols))
+        coarse_img = cv2.resize(
+            img,
+            (max(1, round(cols * scale)), max(1, round(rows * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+        unique_colors, counts, _ = compress_colors(coarse_img)
+        differences = self.palette.differences(unique_colors)[:, 0, :]
+        shortlist_size = min(max(self.shortlist_size, clusters), len(self.palette))
+        shortlist, _, _ = self.select_colors(differences, counts, shortlist_size)
+        return shortlist
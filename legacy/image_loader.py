@@ -0,0 +1,114 @@
+import cv2
+import numpy as np
+
+# how many times the template's size a reduced decode must still be, so that
+# resizing it down to the template averages over enough pixels
+MIN_OVERSAMPLE = 4
+
+REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    1: cv2.IMREAD_COLOR,
+}
+
+# start of frame markers, which hold the image size; 0xC4, 0xC8 and 0xCC are other
+# markers in the same range
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_jpeg_size(data):
+    """
+    Returns the (rows, cols) of a JPEG from its header without decoding it, or None
+    if data isn't a JPEG. The size is before any EXIF rotation.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # padding before a marker
+            i += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a length
+            i += 2
+        elif marker in JPEG_SOF_MARKERS:
+            return (
+                int.from_bytes(data[i + 5 : i + 7], "big"),
+                int.from_bytes(data[i + 7 : i + 9], "big"),
+            )
+        else:
+            i += 2 + int.from_bytes(data[i + 2 : i + 4], "big")
+    return None
+
+
+def choose_reduction(rows, cols, width, height):
+    """
+    Returns the largest factor (8, 4, 2 or 1) by which a rows x cols JPEG can be
+    shrunk while decoding that leaves it at least MIN_OVERSAMPLE times the size of
+    a width x height template.
+    """
+    for factor in (8, 4, 2):
+        # libjpeg rounds scaled sizes up
+        if (
+            -(-rows // factor) >= MIN_OVERSAMPLE * height
+            and -(-cols // factor) >= MIN_OVERSAMPLE * width
+        ):
+            return factor
+    return 1
+
+
+def decode_image(data, chooser, width=None, height=None):
+    """
+    Decodes an image for chooser, given its encoded bytes and the requested
+    template size. Returns the image and the template's (width, height), which is
+    what the chooser's get_dimentions() gives for the image at full size.
+
+    A JPEG is decoded at the smallest scale libjpeg can produce cheaply (by
+    skipping DCT coefficients) which still has plenty of pixels for the template,
+    unless the chooser needs FULL_RESOLUTION. Returns None for the image if it
+    can't be decoded.
+    """
+    buf = np.frombuffer(data, np.uint8)
+    size = None if chooser.FULL_RESOLUTION else read_jpeg_size(data)
+    if size is None:
+        with chooser.instrumentation.span("decode", reduction=1):
+            img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        if img is None:
+            return None, (width, height)
+        return img, chooser.get_dimentions(img, width, height)
+
+    rows, cols = size
+    # the template size only depends on the image's shape, so work it out for the
+    # full size image from a zero byte view of that shape
+    full_dimentions = chooser.get_dimentions(
+        np.broadcast_to(np.uint8(0), (rows, cols, 3)), width, height
+    )
+    rotated_dimentions = chooser.get_dimentions(
+        np.broadcast_to(np.uint8(0), (cols, rows, 3)), width, height
+    )
+    # the image may be turned a quarter by its EXIF orientation, so the factor must
+    # suit either way up
+    factor = min(
+        choose_reduction(rows, cols, *full_dimentions),
+        choose_reduction(cols, rows, *rotated_dimentions),
+    )
+    with chooser.instrumentation.span("decode", reduction=factor):
+        img = cv2.imdecode(buf, REDUCED_FLAGS[factor])
+    if img is None:
+        return None, (width, height)
+    # decoding applies any EXIF rotation, which the header's size doesn't
+    if img.shape[:2] != (-(-rows // factor), -(-cols // factor)):
+        return img, rotated_dimentions
+    return img, full_dimentions
+
+
+def load_image(path, chooser, width=None, height=None):
+    """
+    decode_image() for the image file at path.
+    """
+    with open(path, "rb") as f:
+        return decode_image(f.read(), chooser, width, height)
@@ -0,0 +1,173 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+
+from tqdm import tqdm
+
+
+class Instrumentation:
+    """
+    Reports what a chooser is doing to a list of sinks, each a callable which is
+    given one event dict at a time. Events have an "event" type and a "name":
+
+      * "start" and "end" of a span of work, the end with its wall time in
+        "seconds", the process's "max_rss_bytes" so far and, while tracemalloc is
+        tracing, the "peak_traced_bytes" during the span
+      * "progress" of an iteration of a loop, with its "iteration", the "total"
+        number of iterations if known, and values such as the current "cost"
+      * "message", with its "text"
+
+    plus any fields given where the event was reported. With no sinks nothing is
+    measured or reported, so the choosers run silently.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        # peak traced memory of each open span, for nested spans to update since
+        # each span resets tracemalloc's peak when it starts
+        self.peaks = []
+
+    def emit(self, event, name, **fields):
+        for sink in self.sinks:
+            sink({"event": event, "name": name, **fields})
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        """
+        Context manager reporting the start and end of a span of work.
+        """
+        if not self.sinks:
+            yield
+            return
+        self.emit("start", name, **fields)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = {"seconds": time.perf_counter() - start}
+            # ru_maxrss is in KiB
+            end["max_rss_bytes"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            )
+            if tracing:
+                peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self.peaks:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+                end["peak_traced_bytes"] = peak
+            self.emit("end", name, **fields, **end)
+
+    def progress(self, name, iteration, total=None, **fields):
+        if self.sinks:
+            self.emit("progress", name, iteration=iteration, total=total, **fields)
+
+    def progress_callback(self, name, total=None):
+        """
+        Returns a function of (iteration, cost) reporting the progress of the named
+        loop, or None if there are no sinks, so loops can skip reporting entirely.
+        """
+        if not self.sinks:
+            return None
+
+        def callback(iteration, cost):
+            self.progress(name, iteration, total, cost=float(cost))
+
+        return callback
+
+    def message(self, text, **fields):
+        if self.sinks:
+            self.emit("message", "message", text=text, **fields)
+
+
+class TextSink:
+    """
+    Prints messages and span times, and shows progress bars for loops, to file.
+    """
+
+    def __init__(self, file=sys.stderr):
+        self.file = file
+        self.bars = {}
+
+    def __call__(self, event):
+        if event["event"] == "message":
+            print(event["text"], file=self.file)
+        elif event["event"] == "progress":
+            bar = self.bars.get(event["name"])
+            if bar is None:
+                bar = tqdm(total=event["total"], desc=event["name"], file=self.file)
+                self.bars[event["name"]] = bar
+            values = {
+                key: f"{value:.0f}"
+                for key, value in event.items()
+                if key not in ("event", "name", "iteration", "total")
+            }
+            bar.set_postfix(values, refresh=False)
+            bar.update(event["iteration"] + 1 - bar.n)
+        elif event["event"] == "end":
+            # close the bars of loops which ran inside the span
+            for bar in self.bars.values():
+                bar.close()
+            self.bars = {}
+            print(f"{event['name']}: {event['seconds']:.3f}s", file=self.file)
+
+
+class JsonLogSink:
+    """
+    Appends every event to the file at path as a line of JSON, with the time it
+    was reported.
+    """
+
+    def __init__(self, path):
+        # line buffered so that events from several processes don't interleave
+        self.file = open(path, "a", buffering=1)
+
+    def __call__(self, event):
+        line = json.dumps({"time": time.time(), **event}, default=to_json)
+        self.file.write(line + "\n")
+
+
+def to_json(value):
+    """
+    Converts the numpy values which end up in events to plain Python ones.
+    """
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"can't convert {type(value).__name__} to JSON")
+
+
+class ProfileSink:
+    """
+    Runs cProfile during every span with the given name, and after each one writes
+    the statistics accumulated so far to path (for pstats or snakeviz), or prints
+    the slowest functions if path is None.
+    """
+
+    def __init__(self, path=None, span="choose_colors", top=25):
+        self.path = path
+        self.span = span
+        self.top = top
+        self.profile = cProfile.Profile()
+
+    def __call__(self, event):
+        if event["name"] != self.span:
+            return
+        if event["event"] == "start":
+            self.profile.enable()
+        elif event["event"] == "end":
+            self.profile.disable()
+            if self.path is None:
+                pstats.Stats(self.profile).sort_stats("cumulative").print_stats(
+                    self.top
+                )
+            else:
+                self.profile.dump_stats(self.path)
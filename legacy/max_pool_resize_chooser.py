@@ -3,82 +3,128 @@
 # one which covers the largest fraction of all the squares involved
 
 
-from collections import defaultdict
-
-import math
 import numpy as np
 
 from color_chooser import ColorChooser
-from greedy_chooser import GreedyChooser
-from utils import quantize_img, get_full_color_regions
-from tqdm import tqdm
+from utils import get_row_bands, quantize_indices
 
 
-class MaxPoolResizeChooser(ColorChooser):
-    def arr_to_str(self, arr):
-        return f"{arr[2]:02x}{arr[1]:02x}{arr[0]:02x}"
-
-    def str_to_arr(self, color_string):
-        return tuple(int(color_string[i : i + 2], 16) for i in (4, 2, 0))
-
-    def calc_new_square_components(self, img, resized_col, resized_row, width, height):
-        rows, cols = img.shape[:2]
-        col_frac = cols / width
-        row_frac = rows / height
-
-        new_col_start = col_frac * resized_col
-        new_col_end = col_frac * (resized_col + 1)
-        new_row_start = row_frac * resized_row
-        new_row_end = row_frac * (resized_row + 1)
-
-        result = defaultdict(float)
-        for orig_col in range(math.floor(new_col_start), math.ceil(new_col_end)):
-            for orig_row in range(math.floor(new_row_start), math.ceil(new_row_end)):
-                covered_width = max(orig_col, new_col_start) - min(
-                    orig_col + 1, new_col_end
-                )
-                covered_height = max(orig_row, new_row_start) - min(
-                    orig_row + 1, new_row_end
-                )
-                orig_color_str = self.arr_to_str(img[orig_row, orig_col])
-                result[orig_color_str] += covered_width * covered_height
-        return result
-
-    def calculate_total_score(self, scores, selected_colors):
-        return np.sum(
-            np.max(
-                np.multiply(scores, selected_colors.reshape(np.array([1, 1, -1]))),
-                axis=2,
+def get_overlaps(n_orig, n_resized):
+    """
+    Given the number of pixels along one axis of the original and the resized image,
+    return for each original pixel the first resized pixel it overlaps, and a list
+    of how much of the original pixel falls in that resized pixel and in each of
+    the ones after it. When shrinking each original pixel overlaps at most two
+    resized pixels; when enlarging it can overlap ceil(n_resized / n_orig) + 1.
+    """
+    frac = n_orig / n_resized
+    orig = np.arange(n_orig)
+    first = np.minimum(np.floor(orig / frac).astype(np.int64), n_resized - 1)
+    overlaps = []
+    for offset in range(-(-n_resized // n_orig) + 1):
+        # resized pixels past the last one start after the original pixel ends, so
+        # their overlaps come out as 0
+        square = first + offset
+        overlaps.append(
+            np.clip(
+                np.minimum(orig + 1, (square + 1) * frac)
+                - np.maximum(orig, square * frac),
+                0,
+                None,
             )
         )
+    return first, overlaps
+
+
+class MaxPoolResizeChooser(ColorChooser):
+    # the coverage of each square is measured on the original pixels
+    FULL_RESOLUTION = True
+
+    def __init__(self, color_options, threads=1, **kwargs):
+        super().__init__(color_options, **kwargs)
+        self.threads = threads
+
+    def calc_square_coverage(self, quantized_indices, width, height):
+        """
+        Given the palette index of every pixel of the original image, return a
+        (height, width, n_colors) array of how much of each resized pixel's area, in
+        original pixels, is covered by each color.
+        """
+        n_colors = len(self.palette)
+        rows, cols = quantized_indices.shape
+        row_first, row_overlaps = get_overlaps(rows, height)
+        col_first, col_overlaps = get_overlaps(cols, width)
+        padded_height = height + len(row_overlaps)
+        padded_width = width + len(col_overlaps)
+
+        # every original pixel adds its overlap with each of the resized pixels it
+        # touches (up to 2x2 when shrinking) to that pixel's entry for its color; the
+        # padding rows and columns catch the zero overlaps past the last resized
+        # pixel. Go a band of rows at a time to keep the per-pixel temporaries small.
+        coverage = np.zeros(padded_height * padded_width * n_colors)
+        for band in get_row_bands(rows, cols * 32):
+            for row_offset, row_overlap in enumerate(row_overlaps):
+                row_squares = (row_first[band] + row_offset) * padded_width
+                for col_offset, col_overlap in enumerate(col_overlaps):
+                    squares = row_squares[:, np.newaxis] + col_first + col_offset
+                    coverage += np.bincount(
+                        (squares * n_colors + quantized_indices[band]).ravel(),
+                        weights=np.outer(row_overlap[band], col_overlap).ravel(),
+                        minlength=coverage.size,
+                    )
+        return coverage.reshape(padded_height, padded_width, n_colors)[:height, :width]
+
+    def calculate_total_score(self, scores, selected_colors, counts):
+        return np.sum(np.max(np.multiply(scores, selected_colors), axis=-1) * counts)
+
+    def choose_colors_body(self, img, clusters, width, height, image_hash=None):
+        def compute():
+            # get 1 color per pixel quickly
+            with self.instrumentation.span("quantize"):
+                quantized_indices = quantize_indices(img, self.palette, self.threads)
+            with self.instrumentation.span("coverage"):
+                scores = self.calc_square_coverage(quantized_indices, width, height)
+            return {"scores": scores}
+
+        coverage = self.cached("coverage", img, width, height, compute, image_hash)
+        scores = coverage["scores"]
+
+        # squares with the same coverage of every color score the same, so only
+        # score each distinct coverage once, weighted by how many squares have it
+        scores, inverse, counts = np.unique(
+            scores.reshape(-1, len(self.color_options)),
+            axis=0,
+            return_inverse=True,
+            return_counts=True,
+        )
+        with self.instrumentation.span("selection"):
+            best_selected_colors = self.select_colors(scores, counts, clusters)
 
-    def choose_colors_body(self, img, clusters, width, height):
-        # get 1 color per pixel quickly
-        rows, cols = img.shape[:2]
-        quantized_img = quantize_img(img, self.color_options)
-        print("done quantizing")
-
-        scores = np.zeros((height, width, len(self.color_options)), np.int32)
-        color_indicies = {
-            self.arr_to_str(v): i for i, v in enumerate(self.color_options.values())
-        }
-        full_color_regions = get_full_color_regions(width, height, self.color_options)
-        for resized_col in range(width):
-            for resized_row in range(height):
-                square_components = self.calc_new_square_components(
-                    quantized_img, resized_col, resized_row, width, height
-                )
-                for color_name, score in square_components.items():
-                    scores[resized_row, resized_col, color_indicies[color_name]] = score
+        # get the best score per pixel
+        with self.instrumentation.span("assignment"):
+            max_indices = np.argmax(np.multiply(scores, best_selected_colors), axis=-1)
+            return self.palette.lookup(max_indices[inverse.reshape(height, width)])
 
+    def select_colors(self, scores, counts, clusters):
+        """
+        Given the distinct coverages of squares by each color and how many squares
+        have each, greedily choose the clusters colors which cover the most. Returns
+        a 0/1 array over the palette of which colors are selected.
+        """
         best_selected_colors = np.hstack(
             (
                 np.ones(clusters, dtype=np.float64),
                 np.zeros(len(self.color_options) - clusters, dtype=np.float64),
             )
         )
-        best_score = self.calculate_total_score(scores, best_selected_colors)
-        for i in tqdm(range(clusters + 1, len(self.color_options))):
+        best_score = self.calculate_total_score(scores, best_selected_colors, counts)
+        total = max(0, len(self.color_options) - clusters - 1)
+        for i in range(clusters + 1, len(self.color_options)):
+            if self.deadline is not None and self.deadline.passed():
+                break
+            self.instrumentation.progress(
+                "selection", i - clusters - 1, total, score=best_score
+            )
             new_selection_options = []
             # don't bother with colors which didn't get any score at all
             new_choice_score = self.calculate_total_score(
@@ -90,6 +136,7 @@ class MaxPoolResizeChooser(ColorChooser):
                         np.zeros(len(self.color_options) - i - 1),
                     )
                 ),
+                counts,
             )
             if (new_choice_score) == 0:
                 continue
@@ -101,14 +148,8 @@ class MaxPoolResizeChooser(ColorChooser):
                     new_selection_options.append(new_selection)
             # for each currently chosen color, try replacing it with color i
             for new_selection_option in new_selection_options:
-                score = self.calculate_total_score(scores, new_selection_option)
+                score = self.calculate_total_score(scores, new_selection_option, counts)
                 if score > best_score:
                     best_score = score
                     best_selected_colors = new_selection_option
-        # get the best score per pixel
-        max_indices = np.argmax(
-            np.multiply(scores, best_selected_colors.reshape(np.array([1, 1, -1]))),
-            axis=2,
-        )
-        x, y = np.indices(max_indices.shape)
-        return full_color_regions[x, y, :, max_indices]
+        return best_selected_colors
@@ -0,0 +1,249 @@
+import math
+
+import cv2
+import numpy as np
+
+# the float metrics work through the pixels this many bytes of results at a time,
+# so their pairwise temporaries stay small however many pixels there are
+CHUNK_BYTES = 2**18
+
+
+class Metric:
+    """
+    A way of measuring how different two colors are. A Palette converts its colors
+    with to_lab() and computes their side of the formula once with prepare(), which
+    returns a dict of (n_colors, ...) arrays; each image is converted with to_lab()
+    too, and differences(lab_img, terms) then gives the difference from every pixel
+    to every prepared palette color (or a selection of them) as a
+    (rows, cols, n_colors) array of self.dtype.
+    """
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+
+
+class SquaredLab(Metric):
+    """
+    The squared Euclidean distance between OpenCV's 8 bit L*A*B* values, which is
+    exact in integers. This is what the choosers have always used.
+    """
+
+    def __init__(self, dtype=np.int32):
+        super().__init__(dtype)
+
+    def to_lab(self, img):
+        return cv2.cvtColor(img, cv2.COLOR_BGR2LAB).astype(self.dtype)
+
+    def prepare(self, lab):
+        return {"lab": lab}
+
+    def combine(self, diff):
+        np.multiply(diff, diff, out=diff)
+
+    def differences(self, lab_img, terms):
+        lab = terms["lab"].astype(self.dtype)
+
+        # accumulate one channel at a time into preallocated arrays so the only
+        # temporary is a single buffer the size of the result
+        differences = np.zeros(lab_img.shape[:2] + (len(lab),), self.dtype)
+        diff = np.empty_like(differences)
+        for channel in range(3):
+            np.subtract(lab_img[:, :, channel, np.newaxis], lab[:, channel], out=diff)
+            self.combine(diff)
+            differences += diff
+        return differences
+
+
+class AbsoluteLab(SquaredLab):
+    """
+    The sum of the absolute differences between OpenCV's 8 bit L*A*B* values, as
+    most_similar_color.py has always ranked colors.
+    """
+
+    def combine(self, diff):
+        np.abs(diff, out=diff)
+
+
+class FloatMetric(Metric):
+    """
+    A metric on true CIE L*A*B* (L from 0 to 100) as floats. differences() works
+    through CHUNK_BYTES of results at a time, passing kernel(L, a, b, terms) a
+    column of pixels' channels to compare with the palette terms across the
+    columns; subclasses implement kernel().
+    """
+
+    def __init__(self, dtype=np.float32):
+        # float metrics can't give integer differences
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.float32
+        super().__init__(dtype)
+
+    def to_lab(self, img):
+        return cv2.cvtColor(img.astype(np.float32) / 255, cv2.COLOR_BGR2LAB)
+
+    def prepare(self, lab):
+        return {"L": lab[:, 0], "a": lab[:, 1], "b": lab[:, 2]}
+
+    def differences(self, lab_img, terms):
+        n_colors = len(terms["L"])
+        differences = np.empty(lab_img.shape[:-1] + (n_colors,), self.dtype)
+        pixels = lab_img.reshape(-1, 3)
+        flat = differences.reshape(-1, n_colors)
+        chunk = max(1, CHUNK_BYTES // max(1, n_colors * self.dtype.itemsize))
+        terms = {name: term.astype(self.dtype) for name, term in terms.items()}
+        for start in range(0, len(pixels), chunk):
+            # pixels down the rows, palette colors across the columns
+            chunk_pixels = pixels[start : start + chunk].astype(self.dtype)
+            flat[start : start + chunk] = self.kernel(
+                *(chunk_pixels[:, [channel]] for channel in range(3)), terms
+            )
+        return differences
+
+
+class DeltaE76(FloatMetric):
+    """
+    CIE76: the Euclidean distance in L*A*B*.
+    """
+
+    def kernel(self, L, a, b, terms):
+        result = np.square(L - terms["L"])
+        result += np.square(a - terms["a"])
+        result += np.square(b - terms["b"])
+        return np.sqrt(result, out=result)
+
+
+class WeightedLightness(DeltaE76):
+    """
+    CIE76 with differences in lightness divided by lightness_weight, like the
+    textile versions of CMC and CIE94 (l = 2), so that shading in a photo counts
+    for less than a change of hue. L is scaled when converting, so the kernel is
+    CIE76's.
+    """
+
+    def __init__(self, dtype=np.float32, lightness_weight=2):
+        super().__init__(dtype)
+        self.lightness_weight = lightness_weight
+
+    def to_lab(self, img):
+        lab = super().to_lab(img)
+        lab[..., 0] /= self.lightness_weight
+        return lab
+
+
+class DeltaE94(FloatMetric):
+    """
+    CIE94 with the graphic arts constants, taking the palette color as the
+    reference, so its weights for chroma and hue are palette terms.
+    """
+
+    K1 = 0.045
+    K2 = 0.015
+
+    def prepare(self, lab):
+        terms = super().prepare(lab)
+        C = np.hypot(lab[:, 1], lab[:, 2])
+        terms["C"] = C
+        terms["inv_SC2"] = 1 / np.square(1 + self.K1 * C)
+        terms["inv_SH2"] = 1 / np.square(1 + self.K2 * C)
+        return terms
+
+    def kernel(self, L, a, b, terms):
+        # dH^2 = da^2 + db^2 - dC^2, so
+        # dE^2 = dL^2 + dC^2 / SC^2 + dH^2 / SH^2
+        #      = dL^2 + dC^2 (1 / SC^2 - 1 / SH^2) + (da^2 + db^2) / SH^2
+        result = np.square(a - terms["a"])
+        result += np.square(b - terms["b"])
+        result *= terms["inv_SH2"]
+        result += np.square(np.hypot(a, b) - terms["C"]) * (
+            terms["inv_SC2"] - terms["inv_SH2"]
+        )
+        result += np.square(L - terms["L"])
+        # rounding can take it just below zero
+        np.maximum(result, 0, out=result)
+        return np.sqrt(result, out=result)
+
+
+class CIEDE2000(FloatMetric):
+    """
+    CIEDE2000, following Sharma, Wu and Dalal's notes on implementing it. Nearly
+    every term depends on both colors, so only the palette's chroma and b*^2 are
+    prepared.
+    """
+
+    def prepare(self, lab):
+        terms = super().prepare(lab)
+        terms["C"] = np.hypot(lab[:, 1], lab[:, 2])
+        terms["b_squared"] = np.square(lab[:, 2])
+        return terms
+
+    def kernel(self, L, a, b, terms):
+        L2, a2, b2 = terms["L"], terms["a"], terms["b"]
+        pow25_7 = self.dtype.type(25.0**7)
+        pi = self.dtype.type(np.pi)
+        two_pi = 2 * pi
+
+        C_mean7 = ((np.hypot(a, b) + terms["C"]) / 2) ** 7
+        G = 0.5 * (1 - np.sqrt(C_mean7 / (C_mean7 + pow25_7)))
+        a1p = a * (1 + G)
+        a2p = a2 * (1 + G)
+        # np.hypot and % are several times slower than the arithmetic they stand
+        # for, so they're avoided on the pairwise arrays
+        C1p = np.sqrt(np.square(a1p) + np.square(b))
+        C2p = np.sqrt(np.square(a2p) + terms["b_squared"])
+        h1p = np.arctan2(b, a1p)
+        h1p += (h1p < 0) * two_pi
+        h2p = np.arctan2(b2, a2p)
+        h2p += (h2p < 0) * two_pi
+
+        # the hue difference and mean go the short way round the circle, with hues
+        # exactly opposite going the way Sharma et al. do. Hues which are opposite
+        # in exact arithmetic can come out a few ulps past pi apart, so within
+        # tie of pi counts as pi. Both only matter when neither color is neutral
+        # (dHp is 0 otherwise), so neutral colors need no special case
+        tie = 16 * np.finfo(self.dtype).eps * pi
+        dhp = h2p - h1p
+        dhp -= (dhp > pi + tie) * two_pi
+        dhp += (dhp < -pi - tie) * two_pi
+        dHp = 2 * np.sqrt(C1p * C2p) * np.sin(dhp / 2)
+        h_sum = h1p + h2p
+        h_mean = h_sum / 2
+        h_mean += (np.abs(h1p - h2p) > pi + tie) * np.where(h_sum < two_pi, pi, -pi)
+
+        T = (
+            1
+            - 0.17 * np.cos(h_mean - math.radians(30))
+            + 0.24 * np.cos(2 * h_mean)
+            + 0.32 * np.cos(3 * h_mean + math.radians(6))
+            - 0.20 * np.cos(4 * h_mean - math.radians(63))
+        )
+        # away from blue the exponential is negligible, and left to itself it would
+        # underflow to numbers too tiny for np.exp() and np.sin() to be fast on, so
+        # it's cut off to exactly 0 past e^-40
+        hue_distance = np.square((h_mean - math.radians(275)) / math.radians(25))
+        d_theta = math.radians(30) * np.exp(-np.minimum(hue_distance, 40))
+        d_theta *= hue_distance < 40
+        Cp_mean = (C1p + C2p) / 2
+        Cp_mean7 = Cp_mean**7
+        R_T = -2 * np.sqrt(Cp_mean7 / (Cp_mean7 + pow25_7)) * np.sin(2 * d_theta)
+        L_mean50 = np.square((L + L2) / 2 - 50)
+        S_L = 1 + 0.015 * L_mean50 / np.sqrt(20 + L_mean50)
+
+        dL = (L2 - L) / S_L
+        dC = (C2p - C1p) / (1 + 0.045 * Cp_mean)
+        dH = dHp / (1 + 0.015 * Cp_mean * T)
+        result = np.square(dL)
+        result += np.square(dC)
+        result += np.square(dH)
+        result += R_T * dC * dH
+        np.maximum(result, 0, out=result)
+        return np.sqrt(result, out=result)
+
+
+METRICS = {
+    "lab": SquaredLab,
+    "lab-l1": AbsoluteLab,
+    "de76": DeltaE76,
+    "de94": DeltaE94,
+    "ciede2000": CIEDE2000,
+    "weighted-lightness": WeightedLightness,
+}
@@ -2,14 +2,42 @@
 
 import argparse
 import json
+import sys
 
-import cv2
 import numpy as np
 
+from metrics import METRICS
+from palette import Palette
 
 ap = argparse.ArgumentParser()
 ap.add_argument(
-    "-c", "--color", required=True, type=str, help="color to check (in hex format)"
+    "-c",
+    "--color",
+    action="append",
+    type=str,
+    help="color to check (in hex format), may be repeated",
+)
+ap.add_argument(
+    "-f",
+    "--file",
+    type=str,
+    help="file of colors to check, one hex color per line; colors are read from "
+    "stdin if neither this nor --color is given",
+)
+ap.add_argument(
+    "-k", "--top", type=int, default=10, help="number of matches to show per color"
+)
+ap.add_argument(
+    "--json",
+    action="store_true",
+    help="print one line of JSON per color, as each chunk of input is ranked",
+)
+ap.add_argument(
+    "--metric",
+    type=str,
+    choices=list(METRICS),
+    default="lab-l1",
+    help="how to measure the difference between colors",
 )
 ap.add_argument(
     "-",
@@ -19,23 +47,98 @@ ap.add_argument(
     default="color_names.json",
 )
 
+# colors read from a file or stdin are ranked this many at a time
+CHUNK_SIZE = 4096
+
 
-def get_ranked_colors(color, color_options):
-    # create image with one pixel containing just the color
-    color_img = np.zeros((1, 1, 3), np.uint8)
-    color_img[:, :, :] = color
-    color_lab_img = cv2.cvtColor(color_img, cv2.COLOR_BGR2LAB)
+def parse_hex(color):
+    """
+    Given a color like "#ff8000" or "ff8000", return it as a BGR tuple.
+    """
+    color_hex = color.strip().lstrip("#")
+    if len(color_hex) != 6:
+        raise ValueError(f"not a hex color: {color!r}")
+    # int() raises ValueError itself for anything else which isn't hex
+    return tuple(int(color_hex[i : i + 2], 16) for i in (4, 2, 0))
 
-    # diff each of the options
-    differences = {}
-    for name, color in color_options.items():
-        solid_img = np.zeros((1, 1, 3), np.uint8)
-        solid_img[:, :, :] = color
-        solid_img_lab = cv2.cvtColor(solid_img, cv2.COLOR_BGR2LAB)
-        diff = abs(color_lab_img.astype("float") - solid_img_lab.astype("float"))
-        differences[name] = np.sum(diff, axis=2)[0][0]
 
-    return sorted(differences.items(), key=lambda item: item[1])
+def get_distances(colors, palette):
+    """
+    Given an (n, 3) array of BGR colors, return the (n, n_palette_colors)
+    differences from each to every palette color by the palette's metric.
+    """
+    # compare every color at once as a one column image
+    colors_img = np.asarray(colors, np.uint8).reshape(-1, 1, 3)
+    return palette.differences(colors_img)[:, 0, :].astype("float")
+
+
+def get_top_colors(colors, palette, top=10):
+    """
+    Given an (n, 3) array of BGR colors, return the palette indices of the top
+    closest palette colors to each, closest first, and their differences, as two
+    (n, top) arrays.
+    """
+    distances = get_distances(colors, palette)
+    top = min(top, len(palette))
+    # only the top columns need sorting, so partition them off first
+    indices = np.argpartition(distances, top - 1, axis=1)[:, :top]
+    top_distances = np.take_along_axis(distances, indices, 1)
+    order = np.argsort(top_distances, axis=1, kind="stable")
+    return (
+        np.take_along_axis(indices, order, 1),
+        np.take_along_axis(top_distances, order, 1),
+    )
+
+
+def get_ranked_colors(color, palette):
+    # diff against every option at once using the palette's precomputed terms
+    differences = get_distances([color], palette)[0]
+
+    return sorted(zip(palette.names, differences), key=lambda item: item[1])
+
+
+def read_colors(args):
+    """
+    Yields the colors to check, given on the command line, in a file or on stdin.
+    """
+    if args.color is not None:
+        yield from args.color
+    if args.file is not None:
+        with open(args.file) as f:
+            yield from f
+    elif args.color is None:
+        yield from sys.stdin
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def print_matches(color, color_bgr, indices, differences, palette, as_json):
+    if as_json:
+        matches = [
+            {
+                "name": palette.names[i],
+                "bgr": palette.bgr[i].tolist(),
+                "difference": float(difference),
+            }
+            for i, difference in zip(indices.tolist(), differences)
+        ]
+        print(json.dumps({"input": color, "bgr": color_bgr, "matches": matches}))
+    else:
+        print(f"input bgr: {tuple(color_bgr)}")
+        print(
+            f"Closest matches (name, bgr, {palette.metric_name} difference from input)"
+        )
+        for i, difference in zip(indices.tolist(), differences):
+            print(palette.names[i], palette.bgr[i], difference)
 
 
 if __name__ == "__main__":
@@ -43,10 +146,31 @@ if __name__ == "__main__":
 
     with open(args.color_options) as f:
         color_options = {name: np.array(color) for name, color in json.load(f).items()}
-    color_hex = args.color.lstrip("#")
-    color_bgr = tuple(int(color_hex[i : i + 2], 16) for i in (4, 2, 0))
-    print(f"input bgr: {color_bgr}")
-    print("Closest matches (name, bgr, sum of bgr difference from input)")
-    ranked_colors = get_ranked_colors(color_bgr, color_options)
-    for name, bgr_diff in ranked_colors[:10]:
-        print(name, color_options[name], bgr_diff)
+    palette = Palette(color_options, metric=args.metric)
+
+    lines = (line.strip() for line in read_colors(args))
+    for chunk in iter_chunks((line for line in lines if line), CHUNK_SIZE):
+        colors_bgr = {}
+        for color in chunk:
+            try:
+                colors_bgr[color] = parse_hex(color)
+            except ValueError:
+                pass
+        if colors_bgr:
+            indices, differences = get_top_colors(
+                list(colors_bgr.values()), palette, args.top
+            )
+            ranks = dict(zip(colors_bgr, zip(indices, differences)))
+        # print in the order given, with an error for each color which isn't valid
+        for color in chunk:
+            if color not in colors_bgr:
+                error = f"not a hex color: {color!r}"
+                if args.json:
+                    print(json.dumps({"input": color, "error": error}))
+                else:
+                    print(error, file=sys.stderr)
+                continue
+            print_matches(
+                color, list(colors_bgr[color]), *ranks[color], palette, args.json
+            )
+        sys.stdout.flush()
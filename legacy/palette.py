@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+import numpy as np
+
+from metrics import METRICS
+from utils import find_nearest_indices, pack_colors
+
+
+class Palette:
+    """
+    A palette of named BGR colors, converted to L*A*B* once up front so that
+    distances to every color can be computed for a whole image by broadcasting.
+    Colors are compared by one of the metrics in metrics.METRICS, by default the
+    squared distance between OpenCV's 8 bit L*A*B* values. If table_dir is given,
+    the closest palette color for every possible BGR value is cached there (see
+    get_nearest_table()).
+    """
+
+    def __init__(self, color_options, dtype=np.int32, table_dir=None, metric="lab"):
+        self.names = list(color_options.keys())
+        self.bgr = np.array(
+            [np.asarray(color) for color in color_options.values()]
+        ).astype(np.uint8)
+        self.metric_name = metric
+        self.metric = METRICS[metric](dtype)
+        # float metrics give float differences whatever dtype is
+        self.dtype = self.metric.dtype
+        # the palette's side of the metric, worked out once
+        self.terms = self.metric.prepare(
+            self.metric.to_lab(self.bgr.reshape(-1, 1, 3)).reshape(-1, 3)
+        )
+        self.table_dir = table_dir
+        self.nearest_table = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def to_lab(self, img):
+        """
+        Converts a BGR image to L*A*B*, as the metric expects it.
+        """
+        return self.metric.to_lab(img)
+
+    def differences(self, img, colors=None):
+        """
+        Given a BGR image, return the difference per pixel per palette color by the
+        palette's metric, as a (rows, cols, n_colors) array of self.dtype. If colors
+        is given, only the differences to those palette indices are computed, in
+        that order.
+        """
+        return self.lab_differences(self.to_lab(img), colors)
+
+    def lab_differences(self, lab_img, colors=None):
+        """
+        Like differences(), for an image already converted with to_lab().
+        """
+        terms = self.terms
+        if colors is not None:
+            terms = {name: term[colors] for name, term in terms.items()}
+        return self.metric.differences(lab_img, terms)
+
+    def hash(self):
+        """
+        Returns a hex digest identifying the palette's colors, in order, and its
+        metric if that isn't the default.
+        """
+        digest = hashlib.sha1(self.bgr.tobytes())
+        if self.metric_name != "lab":
+            digest.update(self.metric_name.encode())
+        return digest.hexdigest()
+
+    def get_nearest_table(self, threads=1):
+        """
+        Returns a (256, 256, 256) array indexed by [b, g, r] giving the index of the
+        closest palette color to every BGR value. The table is built the first time
+        a palette needs it and saved in self.table_dir under the palette's hash;
+        after that it is memory-mapped from there.
+        """
+        if self.nearest_table is None:
+            path = os.path.join(self.table_dir, f"nearest_{self.hash()}.npy")
+            if not os.path.exists(path):
+                # an image with one pixel per BGR value, with rows running over b
+                # and g and columns over r
+                values = np.arange(256, dtype=np.uint8)
+                all_colors = np.empty((256, 256, 256, 3), np.uint8)
+                all_colors[..., 0] = values[:, np.newaxis, np.newaxis]
+                all_colors[..., 1] = values[:, np.newaxis]
+                all_colors[..., 2] = values
+                table = find_nearest_indices(
+                    all_colors.reshape(256 * 256, 256, 3), self, threads
+                ).reshape(256, 256, 256)
+
+                # write under a temporary name first so other processes never see
+                # a partial table
+                os.makedirs(self.table_dir, exist_ok=True)
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    np.save(f, table)
+                os.replace(temp_path, path)
+            self.nearest_table = np.load(path, mmap_mode="r")
+        return self.nearest_table
+
+    def find_indices(self, img):
+        """
+        Given an image made only of palette colors, return each pixel's palette index.
+        """
+        keys = pack_colors(self.bgr)
+        order = np.argsort(keys, kind="stable")
+        positions = np.searchsorted(keys[order], pack_colors(img))
+        return order[positions].astype(np.min_scalar_type(len(self) - 1))
+
+    def lookup(self, indices):
+        """
+        Given an array of palette indices, return the image made of the
+        corresponding BGR colors.
+        """
+        return self.bgr[indices]
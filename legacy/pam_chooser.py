@@ -0,0 +1,60 @@
+import numpy as np
+
+from greedy_chooser import GreedyChooser
+from utils import calculate_swap_cost_matrix, get_nearest_two
+
+
+def swap_selection(differences, counts, selected_colors, progress=None, deadline=None):
+    """
+    Improve a selection of palette colors by local search in the style of PAM: each
+    iteration scores every (selected, unselected) swap at once and makes the one
+    that lowers the total cost the most, until no swap lowers it. Takes and returns
+    the same values as greedy_selection() does, and progress is called after each
+    swap. Stops early, like greedy_selection(), once the deadline passes.
+    """
+    n_colors = differences.shape[1]
+    selected_colors = np.array(selected_colors)
+    nearest, best, second = get_nearest_two(differences, selected_colors)
+    cost = np.sum(best * counts, dtype=np.float64)
+    candidates = np.setdiff1d(np.arange(n_colors), selected_colors)
+    iteration = 0
+    while len(candidates) > 0:
+        if deadline is not None and deadline.passed():
+            break
+        costs = calculate_swap_cost_matrix(
+            differences[:, candidates], nearest, best, second, selected_colors, counts
+        )
+        j, i = np.unravel_index(np.argmin(costs), costs.shape)
+        if costs[j, i] >= cost:
+            break
+        cost = costs[j, i]
+        candidates[i], selected_colors[j] = selected_colors[j], candidates[i]
+        selected_colors = np.sort(selected_colors)
+        candidates = np.sort(candidates)
+        nearest, best, second = get_nearest_two(differences, selected_colors)
+        if progress is not None:
+            progress(iteration, cost)
+        iteration += 1
+    return selected_colors, nearest, cost
+
+
+class PamChooser(GreedyChooser):
+    def select_colors(self, differences, counts, clusters):
+        # start from the greedy selection, so the result is never worse than it
+        selected_colors, _, _ = super().select_colors(differences, counts, clusters)
+        return swap_selection(
+            differences,
+            counts,
+            selected_colors,
+            self.instrumentation.progress_callback("swap"),
+            self.deadline,
+        )
+
+    def refine_colors(self, differences, counts, selected_colors):
+        return swap_selection(
+            differences,
+            counts,
+            selected_colors,
+            self.instrumentation.progress_callback("swap"),
+            self.deadline,
+        )
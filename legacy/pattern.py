@@ -0,0 +1,483 @@
+import json
+import struct
+import zlib
+from collections.abc import MutableMapping
+
+import cv2
+import numpy as np
+
+from utils import MAX_BAND_BYTES, get_row_bands, pack_colors
+
+
+class Pattern:
+    """
+    A finished template: a grid of symbols, each the index of one of the template's
+    colors, plus those colors' BGR values, palette names and how many squares have
+    each. Colors are numbered in the order they're listed, which is the order of
+    the stats image. This is all a template needs; the images are rendered from it
+    with preview(), stats_image() and grid_image(). A chooser also records the
+    template's cost and whether its search finished before the deadline.
+    """
+
+    def __init__(self, grid, names, colors, counts=None, cost=None, finished=True):
+        self.grid = np.asarray(grid, np.min_scalar_type(max(len(names) - 1, 0)))
+        self.names = list(names)
+        self.colors = np.asarray(colors, np.uint8).reshape(-1, 3)
+        if counts is None:
+            counts = np.bincount(self.grid.ravel(), minlength=len(self.names))
+        self.counts = np.asarray(counts, np.int64)
+        self.cost = cost
+        self.finished = finished
+
+    @classmethod
+    def from_image(cls, img, palette, order="seen"):
+        """
+        Given an image made only of a Palette's colors, return its Pattern. Colors
+        are numbered in the order they're first seen going down each column from
+        the left ("seen"), by descending count ("count"), or in palette order
+        ("palette").
+        """
+        palette_keys = pack_colors(palette.bgr)
+        palette_indices = {key: i for i, key in enumerate(palette_keys.tolist())}
+
+        # transpose so that np.unique's first indices follow the columns
+        keys, first_seen, inverse, counts = np.unique(
+            pack_colors(img).T,
+            return_index=True,
+            return_inverse=True,
+            return_counts=True,
+        )
+        if order == "seen":
+            ordering = np.argsort(first_seen)
+        elif order == "count":
+            ordering = np.lexsort((first_seen, -counts))
+        elif order == "palette":
+            ordering = np.argsort(
+                [palette_indices.get(key, len(palette_keys)) for key in keys.tolist()],
+                kind="stable",
+            )
+        else:
+            raise ValueError(f"unknown color order: {order}")
+
+        # each distinct color's symbol is its position in the ordering
+        symbols = np.empty(len(keys), np.intp)
+        symbols[ordering] = np.arange(len(keys))
+        indices = [palette_indices[key] for key in keys[ordering].tolist()]
+        return cls(
+            symbols[inverse.reshape(img.shape[1::-1])].T,
+            [palette.names[i] for i in indices],
+            palette.bgr[indices],
+            counts[ordering],
+        )
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    def preview(self):
+        """
+        Returns the template as an image with one pixel per square.
+        """
+        return self.colors[self.grid]
+
+    def stats_image(self):
+        """
+        Returns an image listing each color's symbol, name and how many strings
+        (and yards of yarn) it needs.
+        """
+        return render_stats(self.colors, self.names, self.counts)
+
+    def grid_image(self, square_width=20):
+        """
+        Returns the template expanded to square_width pixels per square, with grid
+        lines and each square's symbol. See render_grid().
+        """
+        return render_grid(self.grid, self.colors, square_width)
+
+    def save_grid_image(self, path, square_width=20, max_strip_bytes=MAX_BAND_BYTES):
+        """
+        Writes grid_image() to a PNG at path a strip at a time, so memory use is
+        bounded by max_strip_bytes however large the template is.
+        """
+        rows, cols = self.shape
+        # encoding a strip takes about as much memory again as rendering it
+        strips = iter_grid_strips(
+            self.grid, self.colors, square_width, max_strip_bytes // 2
+        )
+        write_png(path, cols * square_width, rows * square_width, strips)
+
+    def save_pages(
+        self, prefix, page_rows=60, page_cols=40, overlap=2, square_width=20
+    ):
+        """
+        Writes grid_image() as printable pages (see iter_pages()) to
+        {prefix}_{page row}_{page column}.png, returning their paths.
+        """
+        paths = []
+        for page_row, page_col, page in iter_pages(
+            self.grid, self.colors, page_rows, page_cols, overlap, square_width
+        ):
+            paths.append(f"{prefix}_{page_row}_{page_col}.png")
+            cv2.imwrite(paths[-1], page)
+        return paths
+
+    def renderers(self, instrumentation=None):
+        """
+        Returns a dict from the file names choose_colors.py writes to functions
+        rendering those images, inside a span of instrumentation if given. Put it in
+        a LazyImages to render each image the first time it's used.
+        """
+
+        def renderer(name, render):
+            if instrumentation is None:
+                return render
+
+            def render_in_span():
+                with instrumentation.span(name):
+                    return render()
+
+            return render_in_span
+
+        return {
+            "chosen_colors_no_grid.png": self.preview,
+            "stats_img.png": renderer("stats", self.stats_image),
+            "chosen_colors.png": renderer("render", self.grid_image),
+        }
+
+    def to_dict(self):
+        """
+        Returns the pattern as a dict of plain lists, for JSON.
+        """
+        return {
+            "names": self.names,
+            "colors": self.colors.tolist(),
+            "counts": self.counts.tolist(),
+            "grid": self.grid.tolist(),
+            "cost": self.cost,
+            "finished": self.finished,
+        }
+
+    @classmethod
+    def from_dict(cls, pattern):
+        return cls(
+            pattern["grid"],
+            pattern["names"],
+            pattern["colors"],
+            pattern["counts"],
+            pattern.get("cost"),
+            pattern.get("finished", True),
+        )
+
+    def save(self, path):
+        """
+        Writes the pattern to path, as JSON if path ends in .json and otherwise as a
+        compressed .npz.
+        """
+        if str(path).endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(self.to_dict(), f, separators=(",", ":"))
+        else:
+            np.savez_compressed(
+                path,
+                grid=self.grid,
+                names=np.array(self.names),
+                colors=self.colors,
+                counts=self.counts,
+                cost=np.nan if self.cost is None else self.cost,
+                finished=self.finished,
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a pattern written by save().
+        """
+        if str(path).endswith(".json"):
+            with open(path) as f:
+                return cls.from_dict(json.load(f))
+        with np.load(path) as arrays:
+            cost = float(arrays["cost"]) if "cost" in arrays else np.nan
+            return cls(
+                arrays["grid"],
+                arrays["names"].tolist(),
+                arrays["colors"],
+                arrays["counts"],
+                None if np.isnan(cost) else cost,
+                bool(arrays["finished"]) if "finished" in arrays else True,
+            )
+
+
+class LazyImages(MutableMapping):
+    """
+    A dict of images by file name whose values may be functions returning the
+    image instead, which are only called the first time that image is used.
+    """
+
+    def __init__(self, images=()):
+        self.images = dict(images)
+
+    def __getitem__(self, name):
+        image = self.images[name]
+        if callable(image):
+            image = self.images[name] = image()
+        return image
+
+    def __setitem__(self, name, image):
+        self.images[name] = image
+
+    def __delitem__(self, name):
+        del self.images[name]
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def __len__(self):
+        return len(self.images)
+
+
+def make_symbol_tile(pixel, symbol, square_width):
+    """
+    Returns one box of the template: a square of the given color with its symbol
+    drawn on it. Positions and font size are scaled from the 20 pixel layout.
+    """
+    scale = square_width / 20
+    tile = np.empty((square_width, square_width, 3), np.uint8)
+    tile[:, :] = pixel
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    number_color = (0, 0, 0)
+    if max(pixel) < 175:
+        number_color = (255, 255, 255)
+    x = 6 if symbol < 10 else 2
+    cv2.putText(
+        tile,
+        str(symbol),
+        (round(x * scale), round(12 * scale)),
+        font,
+        0.3 * scale,
+        number_color,
+        1,
+        cv2.LINE_AA,
+    )
+    return tile
+
+
+def make_symbol_tiles(colors, square_width):
+    """
+    Returns the box of every symbol, as a (n_symbols, square_width, square_width, 3)
+    array.
+    """
+    return np.array(
+        [
+            make_symbol_tile(pixel, symbol, square_width)
+            for symbol, pixel in enumerate(colors)
+        ]
+    ).reshape(-1, square_width, square_width, 3)
+
+
+def render_grid(grid, colors, square_width=20):
+    """
+    Given a grid of symbols and the BGR color of each symbol, makes an expanded
+    version of the template, where each square is outlined with a black box and
+    every 10 squares there is a light blue line (the same as which shows up on the
+    latch hook canvas), with each square's symbol drawn in it.
+    """
+    return render_squares(grid, make_symbol_tiles(colors, square_width))
+
+
+def render_squares(grid, tiles, rows=slice(None), cols=slice(None)):
+    """
+    Renders the squares of grid in the given slices of rows and columns as they
+    look in the whole template from render_grid(), given each symbol's box from
+    make_symbol_tiles().
+    """
+    n_rows, n_cols = grid.shape
+    row_indices = np.arange(n_rows)[rows]
+    col_indices = np.arange(n_cols)[cols]
+    square_width = tiles.shape[1]
+    part = grid[rows, cols]
+
+    # every square of a symbol gets the same box, so draw each box only once
+    new_img = np.ascontiguousarray(
+        tiles[part]
+        .transpose(0, 2, 1, 3, 4)
+        .reshape(len(row_indices) * square_width, len(col_indices) * square_width, 3)
+    )
+
+    # draw the lines along the right and bottom edge of every box, through a view
+    # of the image indexed by (row, y in box, col, x in box)
+    black = np.array([0, 0, 0], np.uint8)
+    blue = np.array([255, 204, 51], np.uint8)
+    boxes = new_img.reshape(
+        len(row_indices), square_width, len(col_indices), square_width, 3
+    )
+    col_colors = np.where((col_indices % 10 == 9)[:, np.newaxis], blue, black)
+    boxes[:, :, :, square_width - 2 :] = col_colors[:, np.newaxis]
+    row_colors = np.where(
+        ((row_indices - n_rows) % 10 == 9)[:, np.newaxis]
+        & (row_indices > 0)[:, np.newaxis],
+        blue,
+        black,
+    )
+    boxes[:, square_width - 2 :] = row_colors[:, np.newaxis, np.newaxis, np.newaxis]
+    # cv2.line's end cap put the corner of each box in the last column above the
+    # bottom row in that column's line color; keep matching earlier templates
+    if len(col_indices) > 0 and col_indices[-1] == n_cols - 1:
+        boxes[row_indices < n_rows - 1, -1, -1, -1] = col_colors[-1]
+
+    return new_img
+
+
+def iter_grid_strips(grid, colors, square_width=20, max_strip_bytes=MAX_BAND_BYTES):
+    """
+    Yields render_grid()'s image in horizontal strips of whole rows of squares, each
+    using about max_strip_bytes at most, so the whole image is never in memory.
+    """
+    rows, cols = grid.shape
+    tiles = make_symbol_tiles(colors, square_width)
+    # the gathered boxes plus their contiguous copy
+    bytes_per_row = 2 * cols * square_width * square_width * 3
+    for band in get_row_bands(rows, bytes_per_row, max_strip_bytes):
+        yield render_squares(grid, tiles, rows=band)
+
+
+def write_png(path, width, height, strips, level=6):
+    """
+    Writes a PNG of the given size from an iterable of BGR strips of rows, one strip
+    at a time, so only one strip needs to be in memory. cv2.imwrite() can only
+    write a whole image at once.
+    """
+
+    def write_chunk(f, kind, data):
+        f.write(struct.pack(">I", len(data)))
+        f.write(kind + data)
+        f.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, RGB, no interlacing
+        write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        compressor = zlib.compressobj(level)
+        previous = np.zeros((1, width * 3), np.uint8)
+        written = 0
+        for strip in strips:
+            rgb = strip[:, :, ::-1].reshape(len(strip), width * 3)
+            # use the "up" filter, storing each byte minus the one above it, which is
+            # zero for most rows of a template
+            lines = np.empty((len(strip), width * 3 + 1), np.uint8)
+            lines[:, 0] = 2
+            np.subtract(rgb[:1], previous, out=lines[:1, 1:])
+            np.subtract(rgb[1:], rgb[:-1], out=lines[1:, 1:])
+            previous = rgb[-1:].copy()
+            written += len(strip)
+            data = compressor.compress(lines)
+            if data:
+                write_chunk(f, b"IDAT", data)
+        if written != height:
+            raise ValueError(f"got {written} rows for a PNG {height} rows high")
+        write_chunk(f, b"IDAT", compressor.flush())
+        write_chunk(f, b"IEND", b"")
+
+
+def get_page_starts(n, page_size, overlap):
+    """
+    Returns the first square of each page along an axis of n squares, with
+    consecutive pages sharing overlap squares.
+    """
+    if not 0 <= overlap < page_size:
+        raise ValueError("the overlap must be smaller than the page")
+    starts = [0]
+    while starts[-1] + page_size < n:
+        starts.append(starts[-1] + page_size - overlap)
+    return starts
+
+
+def iter_pages(grid, colors, page_rows=60, page_cols=40, overlap=2, square_width=20):
+    """
+    Splits render_grid()'s image into pages of at most page_rows by page_cols
+    squares for printing, with overlap rows and columns repeated on neighboring
+    pages. Each page has a margin labelling its first row and column and every
+    tenth one (counting from 1), so pages can be lined up by the labels they share.
+    Yields the page's row and column and its image.
+    """
+    rows, cols = grid.shape
+    tiles = make_symbol_tiles(colors, square_width)
+    scale = square_width / 20
+    top, left = square_width, 2 * square_width
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    for page_row, row_start in enumerate(get_page_starts(rows, page_rows, overlap)):
+        row_band = slice(row_start, min(row_start + page_rows, rows))
+        for page_col, col_start in enumerate(get_page_starts(cols, page_cols, overlap)):
+            col_band = slice(col_start, min(col_start + page_cols, cols))
+            squares = render_squares(grid, tiles, row_band, col_band)
+            page = np.full(
+                (top + squares.shape[0], left + squares.shape[1], 3), 255, np.uint8
+            )
+            page[top:, left:] = squares
+            for i, row in enumerate(range(row_band.start, row_band.stop)):
+                if row == row_start or (row + 1) % 10 == 0:
+                    cv2.putText(
+                        page,
+                        str(row + 1),
+                        (round(2 * scale), top + i * square_width + round(13 * scale)),
+                        font,
+                        0.3 * scale,
+                        (0, 0, 0),
+                        1,
+                        cv2.LINE_AA,
+                    )
+            for i, col in enumerate(range(col_band.start, col_band.stop)):
+                if col == col_start or (col + 1) % 10 == 0:
+                    cv2.putText(
+                        page,
+                        str(col + 1),
+                        (left + i * square_width + round(2 * scale), round(13 * scale)),
+                        font,
+                        0.3 * scale,
+                        (0, 0, 0),
+                        1,
+                        cv2.LINE_AA,
+                    )
+            yield page_row, page_col, page
+
+
+def render_stats(colors, names, counts):
+    """
+    Given the BGR color, name and count of each symbol, returns an image listing
+    how many of each color are in the template (aka how much of each string color
+    is needed).
+    """
+    width = 20
+    stats_img = np.ones((len(colors) * width, 250, 3), dtype=np.uint8) * 255
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    for i, (pixel, name, num_strings) in enumerate(zip(colors, names, counts)):
+        num_strings = int(num_strings)
+        stats_img[i * width + 2 : i * width + 19, 2:19] = pixel
+        number_color = (0, 0, 0)
+        if max(pixel) < 175:
+            number_color = (255, 255, 255)
+        cv2.putText(
+            stats_img,
+            str(i),
+            (3 if i >= 10 else 7, i * width + 15),
+            font,
+            0.3,
+            number_color,
+            1,
+            cv2.LINE_AA,
+        )
+        cv2.putText(
+            stats_img,
+            name
+            + " "
+            + str(num_strings)
+            + " strings, "
+            + str(round(num_strings * 2.44 / (12 * 3), 1))
+            + " yards",
+            (25, i * width + 13),
+            font,
+            0.3,
+            (0, 0, 0),
+            1,
+            cv2.LINE_AA,
+        )
+    return stats_img
@@ -1,134 +1,256 @@
-import cv2
+import tempfile
+
 import numpy as np
-from numpy import array, uint8
-from pulp import LpProblem, LpMinimize, LpVariable
-
-from color_chooser import ColorChooser
-
-
-class PulpChooser(ColorChooser):
-    def __init__(self, color_options):
-        super().__init__(color_options)
-        self.solid_img = np.zeros((len(color_options), 1, 3), np.uint8)
-        i = 0
-        for name, color in color_options.items():
-            self.solid_img[i, 0, :] = color
-            i += 1
-        self.solid_img_lab = cv2.cvtColor(self.solid_img, cv2.COLOR_BGR2LAB)
-
-    def choose_colors_body(self, img, clusters, width, height):
-        resized_img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
-        lab_img = cv2.cvtColor(resized_img, cv2.COLOR_BGR2LAB)
-
-        prob = LpProblem("Color_choosing", LpMinimize)
-        colors = []
-        color_vars = LpVariable.dicts(
-            f"color_names", list(range(len(self.color_options))), 0, 1, cat="Integer"
+from pulp import (
+    LpAffineExpression,
+    LpMinimize,
+    LpProblem,
+    LpSolutionOptimal,
+    LpStatus,
+    LpVariable,
+    PULP_CBC_CMD,
+    lpSum,
+)
+
+from greedy_chooser import GreedyChooser
+from utils import call_with_time_limit, get_nearest_two, pack_colors
+
+# seconds it takes to build and write the problem per assignment variable, on the
+# slow side, to estimate whether a solve can fit in the time left
+BUILD_SECONDS_PER_VARIABLE = 6e-5
+# seconds between the solver's own time limit and it being killed, for it to write
+# out its best solution
+STOP_MARGIN = 0.5
+
+
+def group_colors(unique_colors, max_groups):
+    """
+    Groups similar distinct colors, given as a (n_unique, 1, 3) image, by leaving
+    out the low bits of each channel: as few bits as gets them into at most
+    max_groups groups. Returns the group index of each color.
+    """
+    for shift in range(9):
+        _, groups = np.unique(
+            pack_colors(unique_colors[:, 0] >> shift), return_inverse=True
         )
-        for row in range(height):
-            for col in range(width):
-                index = row * width + col
-                colors.append(
-                    LpVariable.dicts(
-                        f"colors{index}",
-                        list(range(len(self.color_options))),
-                        0,
-                        1,
-                        cat="Integer",
-                    )
-                )
-                # choose exactly 1 color per pixel
-                prob += sum(colors[index].values()) == 1
-
-        # if a color is chosen somewhere, the corresponding color_vars index must also be true
-        for color in range(len(self.color_options)):
-            prob += (
-                addImplies(
-                    prob,
-                    addOrList(prob, [list(c.values())[color] for c in colors]),
-                    color_vars[color],
-                )
-                >= 1
+        if groups.max() < max_groups:
+            break
+    return groups.reshape(-1)
+
+
+def build_problem(differences, clusters, greedy_colors, greedy_nearest):
+    """
+    Returns the facility location problem for the (n_points, n_colors) differences,
+    already weighted by how many pixels each point stands for, warm-started from
+    the greedy selection, and its per color variables.
+    """
+    n_points, n_colors = differences.shape
+    prob = LpProblem("Color_choosing", LpMinimize)
+    color_vars = [LpVariable(f"use_{c}", cat="Binary") for c in range(n_colors)]
+    # the assignments can stay continuous: with the used colors fixed, sending
+    # each pixel entirely to its closest used color is always optimal
+    assignments = [
+        [LpVariable(f"assign_{p}_{c}", 0, 1) for c in range(n_colors)]
+        for p in range(n_points)
+    ]
+
+    # goal is to minimize squared distance per pixel
+    prob += LpAffineExpression(
+        (assignments[p][c], float(differences[p, c]))
+        for p in range(n_points)
+        for c in range(n_colors)
+    )
+    for p in range(n_points):
+        # choose exactly 1 color per pixel
+        prob += lpSum(assignments[p]) == 1
+        # and only colors which are used
+        for c in range(n_colors):
+            prob += assignments[p][c] <= color_vars[c]
+    # allow a max of c chosen colors
+    prob += lpSum(color_vars) <= clusters
+
+    # start from the greedy selection
+    for c in range(n_colors):
+        color_vars[c].setInitialValue(1 if c in greedy_colors else 0)
+    for p in range(n_points):
+        for c in range(n_colors):
+            assignments[p][c].setInitialValue(1 if c == greedy_nearest[p] else 0)
+    return prob, color_vars
+
+
+def solve_problem(
+    differences, clusters, greedy_colors, greedy_nearest, solver_options, tmp_dir
+):
+    """
+    Builds the problem with build_problem() and solves it with CBC, given the
+    PULP_CBC_CMD options and a directory for its files. Returns the problem's status
+    and solution status, and the indices of the colors it uses. PulpChooser runs
+    this in a child process, so that it can be stopped at any point.
+    """
+    prob, color_vars = build_problem(
+        differences, clusters, greedy_colors, greedy_nearest
+    )
+    solver = PULP_CBC_CMD(msg=False, warmStart=True, **solver_options)
+    solver.tmpDir = tmp_dir
+    prob.solve(solver)
+    used = [c for c, var in enumerate(color_vars) if (var.varValue or 0) > 0.5]
+    return prob.status, prob.sol_status, used
+
+
+class PulpChooser(GreedyChooser):
+    """
+    Chooses colors by solving the selection as a facility location problem: a
+    binary variable per candidate palette color says whether it's used, and a
+    variable per group of image colors and candidate color says whether the group
+    is assigned to it. The solver is warm-started from the greedy selection, and
+    gap_limit (relative MIP gap) lets it stop early with the best selection found
+    so far.
+
+    time_limit (in seconds) is a hard limit: the problem is built and solved in a
+    child process, which is told to stop in time to write out its best selection
+    and killed if it hasn't by then, in which case the greedy selection is used. A
+    deadline given to choose_colors() lowers the limit to the time left. If
+    building the problem alone wouldn't fit (see BUILD_SECONDS_PER_VARIABLE), the
+    solver isn't started at all.
+
+    The problem has a variable per group and candidate, so it's kept small enough
+    to solve at real template sizes: the candidates are the greedy selection plus
+    a shortlist of shortlist_size colors (see shortlist_colors()), and the distinct
+    colors are merged into at most max_groups groups of similar colors (see
+    group_colors()). With both None the problem covers every palette color and
+    distinct color, and its solution is exact. Either way each pixel then gets the
+    closest chosen color, and the greedy selection is kept if it's better.
+    """
+
+    SETTINGS = ("time_limit", "gap_limit", "shortlist_size", "max_groups")
+
+    def __init__(
+        self,
+        color_options,
+        time_limit=None,
+        gap_limit=None,
+        shortlist_size=24,
+        max_groups=400,
+        **kwargs,
+    ):
+        super().__init__(color_options, shortlist_size, **kwargs)
+        self.time_limit = time_limit
+        self.gap_limit = gap_limit
+        self.max_groups = max_groups
+
+    def choose_colors_body(self, img, clusters, width, height, image_hash=None):
+        # one set of variables per distinct color, weighted by its pixel count
+        prepared = self.get_differences(img, width, height, image_hash)
+        resized_img, unique_colors, differences, counts, inverse = (
+            prepared[name]
+            for name in (
+                "resized_img",
+                "unique_colors",
+                "differences",
+                "counts",
+                "inverse",
+            )
+        )
+        with self.instrumentation.span("greedy"):
+            greedy_colors, greedy_nearest, greedy_cost = self.select_colors(
+                differences, counts, clusters
+            )
+
+        selected_colors = None
+        if self.deadline is None or not self.deadline.passed():
+            selected_colors = self.solve(
+                resized_img, unique_colors, differences, counts, clusters, greedy_colors
             )
+        if selected_colors is None:
+            # the solver stopped without a solution of its own
+            selected_colors = greedy_colors
+        nearest, best, _ = get_nearest_two(differences, selected_colors)
+        cost = np.sum(best * counts, dtype=np.float64)
+        if cost > greedy_cost:
+            selected_colors, nearest = greedy_colors, greedy_nearest
+        self.instrumentation.message(
+            f"used {len(selected_colors)} colors", cost=min(cost, greedy_cost)
+        )
 
-        # allow a max of c chosen colors
-        prob += sum(color_vars.values()) <= clusters
-
-        # goal is to minimize squared distance per pixel
-        prob += self.calculateScore(colors, lab_img)
-        prob.solve()
-        print(prob.status)
-        ret = self.retrieve_img(colors, height, width)
-        print(f"used {sum([cv.varValue for cv in color_vars.values()])} colors")
-        return ret
-
-    def calculateScore(self, colors, img):
-        score = 0
-        rows, cols = img.shape[:2]
-        for row in range(rows):
-            for col in range(cols):
-                index = row * cols + col
-                # find non-zero value
-                for i in range(len(self.color_options)):
-                    score += colors[index][i] * np.sum(
-                        (
-                            img[row, col, :].astype("float")
-                            - self.solid_img_lab[i, 0, :].astype("float")
-                        )
-                        ** 2
-                    )
-        return score
-
-    def retrieve_img(self, colors, rows, cols):
-        ret_img = np.zeros((rows, cols, 3), np.uint8)
-        for row in range(rows):
-            for col in range(cols):
-                index = row * cols + col
-                chosen_color = np.argmax([v.varValue for v in colors[index].values()])
-                ret_img[row, col] = self.solid_img[chosen_color]
-        return ret_img
-
-
-and_count = 0
-
-
-def addAnd(prob, a, b):
-    global and_count
-    and_var = LpVariable(f"and_var{and_count}", 0, 1, cat="Integer")
-    prob += and_var >= a + b - 1
-    prob += and_var <= a
-    prob += and_var <= b
-    return and_var
-
-
-or_count = 0
-
-
-def addOr(prob, a, b):
-    global or_count
-    or_var = LpVariable(f"or_var{or_count}", 0, 1, cat="Integer")
-    or_count += 1
-    prob += or_var <= a + b
-    prob += or_var >= a
-    prob += or_var >= b
-    return or_var
-
-
-def addOrList(prob, ints):
-    result = ints[0]
-    for i in ints[1:]:
-        result = addOr(prob, result, i)
-    return result
-
-
-implies_count = 0
-
-
-def addImplies(prob, a, b):
-    global implies_count
-    implies_var = LpVariable(f"implies_var{implies_count}", 0, 1, cat="Integer")
-    implies_count += 1
-    prob += implies_var <= 1 - a + b
-    prob += implies_var >= 1 - a
-    prob += implies_var >= b
-    return implies_var
+        with self.instrumentation.span("assignment"):
+            return self.palette.lookup(nearest[inverse])
+
+    def solve(
+        self, resized_img, unique_colors, differences, counts, clusters, greedy_colors
+    ):
+        """
+        Returns the sorted palette indices the solver chooses, or None if it has no
+        solution of its own.
+        """
+        if self.shortlist_size is None:
+            candidates = np.arange(len(self.palette))
+        else:
+            with self.instrumentation.span("shortlist"):
+                candidates = np.union1d(
+                    self.shortlist_colors(resized_img, clusters), greedy_colors
+                )
+        if self.max_groups is None:
+            groups = np.arange(len(counts))
+        else:
+            groups = group_colors(unique_colors, self.max_groups)
+        # a group's difference to a color is the total over its pixels, so the
+        # problem's cost is the template's if every group gets one color
+        group_differences = np.zeros((groups.max() + 1, len(candidates)))
+        np.add.at(
+            group_differences,
+            groups,
+            differences[:, candidates] * counts.reshape(-1, 1).astype(np.float64),
+        )
+        greedy_positions = np.searchsorted(candidates, greedy_colors)
+        greedy_nearest = greedy_positions[
+            np.argmin(group_differences[:, greedy_positions], axis=1)
+        ]
+        self.instrumentation.message(
+            f"{len(group_differences)} groups of colors, {len(candidates)} candidates"
+        )
+
+        # building and writing the problem happen before the solver's own time limit
+        # starts, so leave time for them, and don't start at all if they won't fit
+        time_limit, by_deadline = self.time_limit, False
+        if self.deadline is not None and (
+            time_limit is None or self.deadline.remaining() < time_limit
+        ):
+            time_limit, by_deadline = self.deadline.remaining(), True
+        solver_options = {"gapRel": self.gap_limit}
+        if time_limit is not None:
+            build_seconds = BUILD_SECONDS_PER_VARIABLE * group_differences.size
+            solver_seconds = time_limit - build_seconds - STOP_MARGIN
+            if solver_seconds <= 0:
+                self.instrumentation.message("no time to solve")
+                if by_deadline:
+                    self.deadline.hit = True
+                return None
+            solver_options["timeLimit"] = solver_seconds
+
+        # the solver's files go in a directory of their own, which is removed even
+        # if the solver is killed before it can clean up
+        args = (
+            group_differences,
+            clusters,
+            greedy_positions,
+            greedy_nearest,
+            solver_options,
+        )
+        with self.instrumentation.span("selection"):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                result = call_with_time_limit(
+                    solve_problem, args + (tmp_dir,), time_limit
+                )
+        if result is None:
+            self.instrumentation.message("solver stopped at the time limit")
+            if by_deadline:
+                self.deadline.hit = True
+            return None
+        status, sol_status, used = result
+        self.instrumentation.message(LpStatus[status])
+        if by_deadline and sol_status != LpSolutionOptimal:
+            # the solver ran out of the time left before the deadline
+            self.deadline.hit = True
+        if not used:
+            return None
+        return candidates[used]
@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+class ResultCache:
+    """
+    An on-disk cache of numpy arrays, stored as one .npz file per key in directory.
+    Keys are hashes of whatever identifies the result (see key()). Once the files
+    take up more than max_bytes, the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        """
+        Returns a hex digest of parts, which may be strings, numbers, None or arrays.
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                digest.update(str(part.shape).encode())
+                digest.update(np.ascontiguousarray(part).tobytes())
+            else:
+                digest.update(repr(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """
+        Returns the dict of arrays stored under key, or None if there isn't one.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+        # the modification time doubles as the last use time for eviction. Another
+        # process may have evicted the file since it was loaded, which is fine, as
+        # the arrays are already in memory
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Stores a dict of arrays under key, then evicts old entries if the cache has
+        grown past max_bytes.
+        """
+        path = self.path(key)
+        # write under a temporary name first so readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+# Serves the color choosers over HTTP, for callers which want the methods the web
+# app doesn't have (pam, pulp) without running the CLI. Templates are made on a
+# pool of worker processes which each load the palette once; requests wait at
+# most --queue-timeout seconds for a worker, and once --queue-size requests are
+# waiting new ones are turned away with 429 so load can't pile up.
+#
+#   python server.py --port 8000
+#   curl -F image=@input.jpg -F clusters=10 -F width=80 localhost:8000/generate
+#
+# POST /generate takes the same multipart form as the web app's
+# app/api/generate/route.ts (image, clusters, width, height, method) plus order,
+# or the raw image as the body with the fields in the query string, and returns
+# the same JSON: a preview PNG, the grid of color numbers and each color's count.
+# GET /health returns how busy the server is.
+
+import argparse
+import asyncio
+import base64
+import email.parser
+import email.policy
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+from greedy_chooser import GreedyChooser
+from image_loader import decode_image
+from metrics import METRICS
+from max_pool_resize_chooser import MaxPoolResizeChooser
+from pam_chooser import PamChooser
+from pulp_chooser import PulpChooser
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--host", default="127.0.0.1", help="address to listen on")
+ap.add_argument("--port", type=int, default=8000, help="port to listen on")
+ap.add_argument(
+    "-j",
+    "--workers",
+    type=int,
+    default=os.cpu_count(),
+    help="number of worker processes making templates",
+)
+ap.add_argument(
+    "--queue-size",
+    type=int,
+    default=16,
+    help="requests which may wait for a worker before new ones get a 429",
+)
+ap.add_argument(
+    "--queue-timeout",
+    type=float,
+    default=30,
+    help="seconds a request may wait for a worker before it gets a 503",
+)
+ap.add_argument(
+    "--max-upload",
+    type=int,
+    default=16,
+    help="largest request body accepted, in MiB",
+)
+ap.add_argument(
+    "--max-size",
+    type=int,
+    default=200,
+    help="largest template width or height accepted, in squares",
+)
+ap.add_argument(
+    "--deadline",
+    type=float,
+    help="seconds after which a request's search for colors stops and uses the best "
+    "colors so far",
+)
+ap.add_argument(
+    "--time-limit",
+    type=float,
+    default=10,
+    help="seconds the pulp solver may take per request before it's stopped and the "
+    "best selection so far is used",
+)
+ap.add_argument(
+    "--metric",
+    type=str,
+    choices=list(METRICS),
+    default="lab",
+    help="how to measure the difference between colors",
+)
+ap.add_argument(
+    "-",
+    "--color-options",
+    type=str,
+    help="path to numpy file of colors to use",
+    default="color_names.json",
+)
+
+METHODS = ("greedy", "pam", "pulp", "mpr")
+ORDERS = ("seen", "count", "palette")
+
+# the choosers used by this worker process by method, set up once by init_worker()
+choosers = None
+
+
+class BadRequest(ValueError):
+    """
+    A request which can't be served as sent; its message is returned to the client.
+    """
+
+
+def init_worker(color_options_path, time_limit, metric):
+    """
+    Load the palette and create a chooser per method for this worker process.
+    """
+    global choosers
+
+    with open(color_options_path) as f:
+        color_options = {name: np.array(color) for name, color in json.load(f).items()}
+    choosers = {
+        "greedy": GreedyChooser(color_options, metric=metric),
+        "pam": PamChooser(color_options, metric=metric),
+        "pulp": PulpChooser(color_options, time_limit=time_limit, metric=metric),
+        "mpr": MaxPoolResizeChooser(color_options, metric=metric),
+    }
+
+
+def parse_form(content_type, body, query):
+    """
+    Returns the fields of a request as a dict of strings, with the image as bytes
+    under "image". The body is either a multipart form or the image itself, with
+    the other fields in the query string.
+    """
+    fields = {name: values[-1] for name, values in parse_qs(query).items()}
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        if not message.is_multipart():
+            raise BadRequest("malformed multipart form")
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "image":
+                fields[name] = part.get_payload(decode=True)
+            elif name is not None:
+                fields[name] = part.get_content().strip()
+    elif body:
+        fields["image"] = body
+    return fields
+
+
+def parse_int(fields, name, low, high, required=False):
+    if fields.get(name) in (None, ""):
+        if required:
+            raise BadRequest(f"{name} is required")
+        return None
+    try:
+        value = int(fields[name])
+    except ValueError:
+        raise BadRequest(f"{name} must be a whole number")
+    if not low <= value <= high:
+        raise BadRequest(f"{name} must be between {low} and {high}")
+    return value
+
+
+def generate(content_type, body, query, max_size, deadline=None):
+    """
+    Makes the template for one request in a worker process, returning the response
+    JSON as a dict. Raises BadRequest for invalid requests.
+    """
+    fields = parse_form(content_type, body, query)
+    method = fields.get("method") or "greedy"
+    if method not in METHODS:
+        raise BadRequest(f"method must be one of {', '.join(METHODS)}")
+    order = fields.get("order") or "seen"
+    if order not in ORDERS:
+        raise BadRequest(f"order must be one of {', '.join(ORDERS)}")
+    chooser = choosers[method]
+    clusters = parse_int(fields, "clusters", 1, len(chooser.palette), required=True)
+    width = parse_int(fields, "width", 1, max_size)
+    height = parse_int(fields, "height", 1, max_size)
+
+    if "image" not in fields:
+        raise BadRequest("image is required")
+    img, (width, height) = decode_image(fields["image"], chooser, width, height)
+    if img is None:
+        raise BadRequest("could not read the image")
+    if not (1 <= width <= max_size and 1 <= height <= max_size):
+        raise BadRequest(f"the template would be {width}x{height}, over {max_size}")
+
+    pattern = chooser.choose_colors(img, clusters, width, height, order, deadline)
+    preview = pattern.preview()
+    # upscaled 2x like the web app's preview
+    preview = np.repeat(np.repeat(preview, 2, axis=0), 2, axis=1)
+    png = cv2.imencode(".png", preview)[1].tobytes()
+    colors = []
+    for i, (name, (b, g, r), count) in enumerate(
+        zip(pattern.names, pattern.colors.tolist(), pattern.counts.tolist())
+    ):
+        colors.append(
+            {
+                "index": i,
+                "name": name,
+                "hex": f"#{r:02x}{g:02x}{b:02x}",
+                "rgb": [r, g, b],
+                "count": count,
+                "yardage": round(count * 2.44 / (12 * 3), 2),
+            }
+        )
+    return {
+        "preview": "data:image/png;base64," + base64.b64encode(png).decode("ascii"),
+        "grid": pattern.grid.tolist(),
+        "dimensions": {"width": width, "height": height},
+        "colors": colors,
+        "totalStrings": width * height,
+        "cost": pattern.cost,
+        "finished": pattern.finished,
+    }
+
+
+class Server:
+    """
+    Handles HTTP connections on the event loop, handing the work of each request to
+    a process pool. At most workers requests are on the pool at once, so the pool
+    never queues work itself; requests past that wait for a slot here, where they
+    can time out, and requests past queue_size waiting are refused.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.slots = asyncio.Semaphore(args.workers)
+        self.pending = 0
+        self.executor = self.make_executor()
+
+    def make_executor(self):
+        return ProcessPoolExecutor(
+            self.args.workers,
+            initializer=init_worker,
+            initargs=(self.args.color_options, self.args.time_limit, self.args.metric),
+        )
+
+    async def handle_connection(self, reader, writer):
+        try:
+            status, response = await self.handle_request(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            # anything unexpected still gets a response rather than a dropped
+            # connection
+            status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {
+                "error": "failed to handle request",
+                "details": f"{type(e).__name__}: {e}",
+            }
+        body = json.dumps(response).encode()
+        headers = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+        ]
+        if status in (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE):
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def handle_request(self, reader):
+        """
+        Reads one request and returns the status and JSON response for it.
+        """
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) != 3:
+            return HTTPStatus.BAD_REQUEST, {"error": "malformed request"}
+        method, target, _ = request_line
+        url = urlsplit(target)
+
+        if url.path == "/health" and method == "GET":
+            return HTTPStatus.OK, {
+                "status": "ok",
+                "workers": self.args.workers,
+                "pending": self.pending,
+            }
+        if url.path != "/generate":
+            return HTTPStatus.NOT_FOUND, {"error": f"no such endpoint {url.path}"}
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "use POST"}
+
+        if "content-length" not in headers:
+            return HTTPStatus.LENGTH_REQUIRED, {"error": "Content-Length is required"}
+        # only plain digits, which int() alone would let through with a sign,
+        # underscores or non-ASCII digits
+        length = headers["content-length"]
+        if not (length.isascii() and length.isdigit()):
+            return HTTPStatus.BAD_REQUEST, {"error": "invalid Content-Length"}
+        length = int(length)
+        if length > self.args.max_upload * 2**20:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {
+                "error": f"uploads are limited to {self.args.max_upload} MiB"
+            }
+        # refuse before reading the body, so a busy server doesn't buffer uploads
+        # it won't use; requests count as pending while their body arrives
+        if self.pending >= self.args.workers + self.args.queue_size:
+            return HTTPStatus.TOO_MANY_REQUESTS, {"error": "too many requests queued"}
+        self.pending += 1
+        try:
+            body = await reader.readexactly(length)
+            return await self.generate(headers.get("content-type", ""), body, url.query)
+        finally:
+            self.pending -= 1
+
+    async def generate(self, content_type, body, query):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.args.queue_timeout)
+        except asyncio.TimeoutError:
+            return HTTPStatus.SERVICE_UNAVAILABLE, {
+                "error": "timed out waiting for a worker"
+            }
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                generate,
+                content_type,
+                body,
+                query,
+                self.args.max_size,
+                self.args.deadline,
+            )
+            return HTTPStatus.OK, response
+        except BadRequest as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        except BrokenProcessPool:
+            # a worker died, e.g. killed for running out of memory; start over
+            # with a fresh pool so later requests still work
+            self.executor.shutdown(wait=False)
+            self.executor = self.make_executor()
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "worker crashed"}
+        except Exception as e:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {
+                "error": "failed to generate template",
+                "details": f"{type(e).__name__}: {e}",
+            }
+        finally:
+            self.slots.release()
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_connection, self.args.host, self.args.port
+        )
+        print(f"serving on http://{self.args.host}:{self.args.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    args = ap.parse_args()
+    try:
+        asyncio.run(Server(args).serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from greedy_chooser import add_best_color
+from pattern import Pattern
+from utils import get_nearest_two
+
+
+class ChooserSession:
+    """
+    Keeps one image's intermediate results for a GreedyChooser or PamChooser, so a
+    template can be made again quickly after changing the number of colors, the
+    size, or which palette colors must or can't be used, as in an editor.
+
+    The differences for the last MAX_SIZES sizes are kept, and each choose() starts
+    from the last selection: colors which are now excluded are dropped and pinned
+    ones added, colors are added or removed to get to the new number of colors,
+    and the result is improved with the chooser's refine_colors(). Only the first
+    choice for an image is made from scratch with select_colors(), so it matches
+    choose_colors() (without a shortlist) when nothing is pinned or excluded.
+    """
+
+    MAX_SIZES = 4
+
+    def __init__(self, chooser, img):
+        self.chooser = chooser
+        self.img = img
+        # hashed once here rather than for every size looked up in the cache
+        self.image_hash = chooser.hash_image(img)
+        self.prepared = OrderedDict()
+        self.pinned = set()
+        self.excluded = set()
+        self.selected_colors = None
+        self.cost = None
+
+    def get_indices(self, names):
+        indices = []
+        for name in names:
+            if name not in self.chooser.palette.names:
+                raise ValueError(f"no color named {name} in the palette")
+            indices.append(self.chooser.palette.names.index(name))
+        return indices
+
+    def pin(self, *names):
+        """
+        Makes the named colors part of every selection from now on. Like any
+        selected color, a pinned color only shows up in the Pattern if it's the
+        closest selected color for some square.
+        """
+        indices = self.get_indices(names)
+        self.pinned.update(indices)
+        self.excluded.difference_update(indices)
+
+    def exclude(self, *names):
+        """
+        Stops the named colors being used, e.g. because they're out of stock.
+        """
+        indices = self.get_indices(names)
+        self.excluded.update(indices)
+        self.pinned.difference_update(indices)
+
+    def reset(self, *names):
+        """
+        Lets the chooser decide whether to use the named colors again.
+        """
+        indices = self.get_indices(names)
+        self.pinned.difference_update(indices)
+        self.excluded.difference_update(indices)
+
+    def get_differences(self, width, height):
+        """
+        Returns the chooser's get_differences() for the image at the given size,
+        keeping those for the most recently used sizes.
+        """
+        size = (width, height)
+        if size in self.prepared:
+            self.prepared.move_to_end(size)
+        else:
+            self.prepared[size] = self.chooser.get_differences(
+                self.img, width, height, self.image_hash
+            )
+            if len(self.prepared) > self.MAX_SIZES:
+                self.prepared.popitem(last=False)
+        return self.prepared[size]
+
+    def choose(self, clusters, width=None, height=None, order="seen"):
+        """
+        Chooses clusters colors (including the pinned ones) for a template of the
+        image and returns it as a Pattern. See ColorChooser.choose_colors().
+        """
+        width, height = self.chooser.get_dimentions(self.img, width, height)
+        prepared = self.get_differences(width, height)
+        differences, counts, inverse = (
+            prepared[name] for name in ("differences", "counts", "inverse")
+        )
+        pinned = np.array(sorted(self.pinned), np.intp)
+        if len(pinned) > clusters:
+            raise ValueError(f"{len(pinned)} colors are pinned, over {clusters}")
+        excluded = np.array(sorted(self.excluded), np.intp)
+        free = np.setdiff1d(
+            np.arange(len(self.chooser.palette)), np.concatenate((pinned, excluded))
+        )
+        n_free = min(clusters - len(pinned), len(free))
+
+        with self.chooser.instrumentation.span("selection"):
+            free_differences = differences[:, free]
+            if len(pinned) > 0:
+                # every pixel can always use its closest pinned color, so choosing
+                # the rest is choosing among the free colors with each difference
+                # capped at the difference to that pinned color
+                free_differences = np.minimum(
+                    free_differences,
+                    np.min(differences[:, pinned], axis=1, keepdims=True),
+                )
+            if n_free == 0:
+                free_selected = np.array([], np.intp)
+            elif self.selected_colors is None:
+                free_selected, _, _ = self.chooser.select_colors(
+                    free_differences, counts, n_free
+                )
+            else:
+                free_selected = self.refine(free_differences, counts, free, n_free)
+
+            self.selected_colors = np.sort(
+                np.concatenate((pinned, free[free_selected]))
+            )
+            nearest, best, _ = get_nearest_two(differences, self.selected_colors)
+            self.cost = float(np.sum(best * counts, dtype=np.float64))
+
+        with self.chooser.instrumentation.span("assignment"):
+            result_img = self.chooser.palette.lookup(nearest[inverse])
+        return Pattern.from_image(result_img, self.chooser.palette, order)
+
+    def refine(self, free_differences, counts, free, n_free):
+        """
+        Returns n_free columns of free_differences to use, starting from the free
+        colors of the last selection.
+        """
+        selected = np.flatnonzero(np.isin(free, self.selected_colors))
+        while len(selected) > n_free:
+            # drop the color whose loss raises the cost the least
+            costs = [
+                np.sum(
+                    np.min(free_differences[:, np.delete(selected, j)], axis=1)
+                    * counts,
+                    dtype=np.float64,
+                )
+                for j in range(len(selected))
+            ]
+            selected = np.delete(selected, np.argmin(costs))
+        while len(selected) < n_free:
+            if len(selected) == 0:
+                selected, _, _ = self.chooser.select_colors(free_differences, counts, 1)
+            else:
+                selected = add_best_color(free_differences, counts, selected)
+        selected, _, _ = self.chooser.refine_colors(free_differences, counts, selected)
+        return selected
+
+    @property
+    def selected_names(self):
+        return [self.chooser.palette.names[c] for c in self.selected_colors]
@@ -0,0 +1,17 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+LEGACY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the scripts import each other as top level modules
+sys.path.insert(0, LEGACY_DIR)
+
+
+@pytest.fixture(scope="session")
+def color_options():
+    with open(os.path.join(LEGACY_DIR, "..", "color_names.json")) as f:
+        return {name: np.array(color) for name, color in json.load(f).items()}
@@ -0,0 +1,42 @@
+import argparse
+import os
+import time
+
+import choose_colors
+
+
+def batch_args(tmp_path, image_paths, workers):
+    manifest = tmp_path / "images.txt"
+    manifest.write_text("".join(f"{path}\n" for path in image_paths))
+    return argparse.Namespace(batch=str(manifest), workers=workers)
+
+
+def fake_process_image(image_path, args):
+    if "crash" in image_path:
+        os._exit(1)
+    time.sleep(0.05)
+
+
+def test_batch_survives_a_dying_worker(tmp_path, monkeypatch, capsys):
+    # workers are forked, so they see the patched functions
+    monkeypatch.setattr(choose_colors, "init_chooser", lambda args: None)
+    monkeypatch.setattr(choose_colors, "process_image", fake_process_image)
+    image_paths = [f"image{i}.png" for i in range(5)]
+    image_paths.insert(2, "crash.png")
+
+    failures = choose_colors.run_batch(batch_args(tmp_path, image_paths, 3))
+
+    assert failures == 1
+    lines = capsys.readouterr().out.splitlines()
+    assert "crash.png: failed, its worker process died" in lines
+    for image_path in image_paths:
+        if image_path != "crash.png":
+            assert sum(line.startswith(f"{image_path}: done") for line in lines) == 1
+
+
+def test_batch_stops_if_workers_die_before_starting(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(choose_colors, "init_chooser", lambda args: os._exit(1))
+    image_paths = ["image0.png", "image1.png"]
+
+    assert choose_colors.run_batch(batch_args(tmp_path, image_paths, 2)) == 2
+    assert "nan" not in capsys.readouterr().out
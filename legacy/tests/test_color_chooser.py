@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import synthetic_image
+from greedy_chooser import GreedyChooser
+from pattern import Pattern
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def hex_color(pixel):
+    return "%.2x%.2x%.2x" % (pixel[2], pixel[1], pixel[0])
+
+
+def reference_color_stats(img, color_options):
+    """
+    make_color_stats() as it was originally written, counting colors by hex string
+    down each column in turn.
+    """
+    color_names = {hex_color([int(c) for c in v]): k for k, v in color_options.items()}
+    colors = {}
+    rows, cols = img.shape[:2]
+    width = 20
+    for i in range(cols):
+        for j in range(rows):
+            color = hex_color(img[j, i])
+            colors[color] = colors.get(color, 0) + 1
+
+    stats_img = np.ones((len(colors) * width, 250, 3), dtype=np.uint8) * 255
+    color_order = {}
+    for i, (color, num_strings) in enumerate(colors.items()):
+        color_order[color] = i
+        bgr = [int(color[4:6], 16), int(color[2:4], 16), int(color[0:2], 16)]
+        stats_img[i * width + 2 : i * width + 19, 2:19] = bgr
+        number_color = (255, 255, 255) if max(bgr) < 175 else (0, 0, 0)
+        x = 3 if i >= 10 else 7
+        cv2.putText(
+            stats_img,
+            str(i),
+            (x, i * width + 15),
+            FONT,
+            0.3,
+            number_color,
+            1,
+            cv2.LINE_AA,
+        )
+        text = (
+            f"{color_names[color]} {num_strings} strings, "
+            f"{round(num_strings * 2.44 / (12 * 3), 1)} yards"
+        )
+        cv2.putText(
+            stats_img,
+            text,
+            (25, i * width + 13),
+            FONT,
+            0.3,
+            (0, 0, 0),
+            1,
+            cv2.LINE_AA,
+        )
+    return stats_img, color_order
+
+
+def reference_lines_and_symbols(img, color_order):
+    """
+    add_lines_and_symbols() as it was originally written, drawing every square's
+    fill, lines and number one pixel at a time.
+    """
+    square_width = 20
+    rows, cols = img.shape[:2]
+    new_img = cv2.resize(img, (cols * square_width, rows * square_width))
+    for i in range(cols):
+        for j in range(rows):
+            pixel = img[j, i]
+            new_img[
+                j * square_width : (j + 1) * square_width - 2,
+                i * square_width : (i + 1) * square_width - 2,
+            ] = pixel
+            right = i * square_width + square_width - 1
+            bottom = j * square_width + square_width - 1
+            color = (255, 204, 51) if i % 10 == 9 and i > 0 else (0, 0, 0)
+            cv2.line(new_img, (right, j * square_width), (right, bottom), color, 2)
+            color = (255, 204, 51) if (j - rows) % 10 == 9 and j > 0 else (0, 0, 0)
+            cv2.line(new_img, (i * square_width, bottom), (right, bottom), color, 2)
+            number_color = (255, 255, 255) if max(pixel) < 175 else (0, 0, 0)
+            symbol = color_order[hex_color(pixel)]
+            x = i * square_width + (6 if symbol < 10 else 2)
+            cv2.putText(
+                new_img,
+                str(symbol),
+                (x, j * square_width + 12),
+                FONT,
+                0.3,
+                number_color,
+                1,
+                cv2.LINE_AA,
+            )
+    return new_img
+
+
+@pytest.mark.parametrize("kind, clusters", [("photo", 12), ("flat", 4)])
+def test_rendering_matches_reference(color_options, kind, clusters):
+    chooser = GreedyChooser(color_options)
+    img = synthetic_image(kind, 240, 160, seed=1)
+    result_img = chooser.choose_colors_body(img, clusters, 23, 21)
+    expected_stats, expected_order = reference_color_stats(result_img, color_options)
+
+    stats_img, color_order = chooser.make_color_stats(result_img)
+    assert np.array_equal(stats_img, expected_stats)
+    grid_img = chooser.add_lines_and_symbols(result_img, color_order)
+    assert np.array_equal(
+        grid_img, reference_lines_and_symbols(result_img, expected_order)
+    )
+    pattern = Pattern.from_image(result_img, chooser.palette)
+    assert np.array_equal(pattern.grid_image(), grid_img)
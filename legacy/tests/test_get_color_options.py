@@ -0,0 +1,31 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+
+from get_color_options import update_palette
+
+
+def write_swatch(path, bgr):
+    cv2.imwrite(str(path), np.full((30, 30, 3), bgr, np.uint8))
+
+
+@pytest.mark.parametrize("full", [False, True])
+def test_deleted_swatches_are_removed(tmp_path, full):
+    swatches = tmp_path / "swatches"
+    swatches.mkdir()
+    write_swatch(swatches / "00000000red.jpg", (0, 0, 255))
+    write_swatch(swatches / "00000000blue.jpg", (255, 0, 0))
+    output = str(tmp_path / "colors.json")
+    with ThreadPoolExecutor(2) as executor:
+        update_palette(str(swatches), output, executor, 8)
+        os.remove(swatches / "00000000red.jpg")
+        update_palette(str(swatches), output, executor, 8, full)
+
+    with open(output) as f:
+        assert list(json.load(f)) == ["blue"]
+    with open(output + ".manifest.json") as f:
+        assert list(json.load(f)) == ["00000000blue.jpg"]
@@ -0,0 +1,56 @@
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import synthetic_image
+from greedy_chooser import GreedyChooser
+
+
+def reference_choose_colors(img, clusters, width, height, color_options):
+    """
+    The greedy selection as the original choose_colors_body() made it, trying every
+    swap on the full (rows, cols, n_colors) differences with NaN for unselected
+    colors.
+    """
+    resized_img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    bgr = np.array(list(color_options.values()), np.uint8)
+    lab = cv2.cvtColor(bgr.reshape(-1, 1, 3), cv2.COLOR_BGR2LAB).reshape(-1, 3)
+    lab_img = cv2.cvtColor(resized_img, cv2.COLOR_BGR2LAB)
+    differences = np.sum(
+        (lab_img[:, :, np.newaxis, :].astype("float") - lab.astype("float")) ** 2,
+        axis=3,
+    ).astype(np.int32)
+
+    def total_cost(selected_colors):
+        return np.sum(np.nanmin(differences * selected_colors, axis=2))
+
+    n_colors = len(color_options)
+    best_selected_colors = np.hstack(
+        (np.ones(clusters), np.full(n_colors - clusters, np.nan))
+    )
+    best_cost = total_cost(best_selected_colors)
+    for i in range(clusters + 1, n_colors):
+        new_selection_options = []
+        for j in range(n_colors):
+            if best_selected_colors[j] == 1:
+                new_selection = best_selected_colors.copy()
+                new_selection[j] = np.nan
+                new_selection[i] = 1
+                new_selection_options.append(new_selection)
+        for new_selection_option in new_selection_options:
+            cost = total_cost(new_selection_option)
+            if cost < best_cost:
+                best_cost = cost
+                best_selected_colors = new_selection_option
+    return bgr[np.nanargmin(differences * best_selected_colors, axis=2)]
+
+
+@pytest.mark.parametrize("kind", ["photo", "flat"])
+@pytest.mark.parametrize("clusters", [3, 10])
+def test_choose_colors_matches_reference(color_options, kind, clusters):
+    img = synthetic_image(kind, 90, 60, seed=clusters)
+    width, height = 30, 20
+    chooser = GreedyChooser(color_options)
+    result_img = chooser.choose_colors_body(img, clusters, width, height)
+    expected = reference_choose_colors(img, clusters, width, height, color_options)
+    assert np.array_equal(result_img, expected)
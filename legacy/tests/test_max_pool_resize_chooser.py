@@ -0,0 +1,58 @@
+import math
+
+import numpy as np
+import pytest
+
+from max_pool_resize_chooser import MaxPoolResizeChooser
+
+
+def reference_coverage(quantized_indices, width, height, n_colors):
+    """
+    The coverage of each resized pixel found one at a time, as the original
+    calc_new_square_components() did.
+    """
+    rows, cols = quantized_indices.shape
+    col_frac = cols / width
+    row_frac = rows / height
+    coverage = np.zeros((height, width, n_colors))
+    for resized_row in range(height):
+        row_start, row_end = row_frac * resized_row, row_frac * (resized_row + 1)
+        for resized_col in range(width):
+            col_start, col_end = col_frac * resized_col, col_frac * (resized_col + 1)
+            for orig_row in range(math.floor(row_start), math.ceil(row_end)):
+                covered_height = min(orig_row + 1, row_end) - max(orig_row, row_start)
+                for orig_col in range(math.floor(col_start), math.ceil(col_end)):
+                    covered_width = min(orig_col + 1, col_end) - max(
+                        orig_col, col_start
+                    )
+                    color = quantized_indices[orig_row, orig_col]
+                    coverage[resized_row, resized_col, color] += (
+                        covered_width * covered_height
+                    )
+    return coverage
+
+
+@pytest.mark.parametrize(
+    "shape, size",
+    [
+        ((70, 50), (13, 17)),  # shrunk
+        ((50, 70), (119, 85)),  # enlarged, as get_dimentions() does small images
+        ((12, 10), (25, 20)),
+        ((9, 31), (40, 7)),  # enlarged one way and shrunk the other
+        ((16, 16), (16, 16)),
+    ],
+)
+def test_square_coverage_matches_reference(color_options, shape, size):
+    chooser = MaxPoolResizeChooser(color_options)
+    n_colors = len(chooser.palette)
+    quantized_indices = np.random.default_rng(0).integers(0, n_colors, shape)
+    width, height = size
+
+    coverage = chooser.calc_square_coverage(quantized_indices, width, height)
+    expected = reference_coverage(quantized_indices, width, height, n_colors)
+    assert coverage.shape == (height, width, n_colors)
+    np.testing.assert_allclose(coverage, expected, atol=1e-9)
+    # every resized pixel covers the same area of the original
+    np.testing.assert_allclose(
+        coverage.sum(axis=-1), shape[0] * shape[1] / (width * height)
+    )
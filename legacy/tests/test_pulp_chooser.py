@@ -0,0 +1,69 @@
+import time
+
+import numpy as np
+import pytest
+
+from benchmark import synthetic_image
+import pulp_chooser
+from greedy_chooser import GreedyChooser
+from pulp_chooser import PulpChooser, group_colors
+from utils import compress_colors
+
+
+def test_group_colors_bounds_the_groups():
+    img = synthetic_image("photo", 60, 40)
+    unique_colors, _, _ = compress_colors(img)
+    for max_groups in (1, 50, 400, len(unique_colors)):
+        groups = group_colors(unique_colors, max_groups)
+        assert groups.shape == (len(unique_colors),)
+        assert groups.max() < max_groups
+    # with room for every color, none are merged
+    groups = group_colors(unique_colors, len(unique_colors))
+    assert len(np.unique(groups)) == len(unique_colors)
+
+
+@pytest.mark.parametrize("kind", ["photo", "flat"])
+def test_bounded_problem_against_exact(color_options, kind):
+    img = synthetic_image(kind, 64, 48)
+    width, height, clusters = 16, 12, 6
+    choosers = {
+        "exact": PulpChooser(color_options, shortlist_size=None, max_groups=None),
+        "shortlist": PulpChooser(color_options),
+        "grouped": PulpChooser(color_options, shortlist_size=12, max_groups=40),
+        "greedy": GreedyChooser(color_options),
+    }
+    costs = {}
+    for name, chooser in choosers.items():
+        result_img = chooser.choose_colors_body(img, clusters, width, height)
+        costs[name] = chooser.template_cost(img, result_img, width, height)
+    # the default shortlist still has the exact solution's colors on images like
+    # these, and however small the problem, it's never worse than greedy
+    assert costs["shortlist"] == costs["exact"]
+    assert costs["exact"] <= costs["grouped"] <= costs["greedy"]
+
+
+# with the real estimate the solve is skipped, and with none it's killed
+@pytest.mark.parametrize("build_seconds", [pulp_chooser.BUILD_SECONDS_PER_VARIABLE, 0])
+def test_time_limit_is_hard(color_options, monkeypatch, build_seconds):
+    monkeypatch.setattr(pulp_chooser, "BUILD_SECONDS_PER_VARIABLE", build_seconds)
+    # the exact problem at this size takes far longer than the limit to solve
+    img = synthetic_image("photo", 120, 90)
+    chooser = PulpChooser(
+        color_options, time_limit=2, shortlist_size=None, max_groups=None
+    )
+    greedy = GreedyChooser(color_options)
+    start = time.monotonic()
+    result_img = chooser.choose_colors_body(img, 8, 60, 45)
+    assert time.monotonic() - start < 4
+    assert np.array_equal(result_img, greedy.choose_colors_body(img, 8, 60, 45))
+
+
+def test_deadline_without_time_to_build(color_options, monkeypatch):
+    # pretend building the problem is slow, so that it can't fit before the deadline
+    monkeypatch.setattr(pulp_chooser, "BUILD_SECONDS_PER_VARIABLE", 1)
+    img = synthetic_image("flat", 64, 48)
+    chooser = PulpChooser(color_options)
+    pattern = chooser.choose_colors(img, 6, 16, 12, deadline=5)
+    assert not pattern.finished
+    greedy = GreedyChooser(color_options).choose_colors(img, 6, 16, 12)
+    assert pattern.cost == greedy.cost
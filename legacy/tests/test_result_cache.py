@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+import result_cache
+from result_cache import ResultCache
+
+
+def test_get_survives_concurrent_eviction(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    key = cache.key("differences", 1)
+    cache.put(key, {"differences": np.arange(6).reshape(2, 3)})
+
+    # another process evicts the entry between get() loading it and touching it
+    utime = os.utime
+
+    def evict_then_utime(path, *args, **kwargs):
+        os.remove(path)
+        return utime(path, *args, **kwargs)
+
+    monkeypatch.setattr(result_cache.os, "utime", evict_then_utime)
+    arrays = cache.get(key)
+    assert np.array_equal(arrays["differences"], np.arange(6).reshape(2, 3))
+    assert cache.get(key) is None
+
+
+def test_evict_removes_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    keys = [cache.key("entry", i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, {"values": np.zeros(1000)})
+        os.utime(cache.path(key), (i, i))
+    # using the oldest entry makes the middle one the least recently used
+    cache.get(keys[0])
+    cache.max_bytes = 2 * os.path.getsize(cache.path(keys[0]))
+    cache.evict()
+    assert [cache.get(key) is not None for key in keys] == [True, False, True]
@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import json
+
+import pytest
+
+from server import Server
+
+
+async def send(server, request):
+    """
+    Feeds a raw request to server.handle_connection() and returns the status code
+    and JSON body of the response it writes.
+    """
+    reader = asyncio.StreamReader()
+    reader.feed_data(request)
+    reader.feed_eof()
+
+    class Writer:
+        data = b""
+
+        def write(self, data):
+            self.data += data
+
+        async def drain(self):
+            pass
+
+        def close(self):
+            pass
+
+    writer = Writer()
+    await server.handle_connection(reader, writer)
+    head, _, body = writer.data.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+
+@pytest.fixture
+def server():
+    args = argparse.Namespace(
+        workers=1,
+        queue_size=1,
+        queue_timeout=1,
+        max_upload=1,
+        max_size=200,
+        deadline=None,
+        time_limit=1,
+        metric="lab",
+        color_options="color_names.json",
+    )
+    server = Server(args)
+    yield server
+    server.executor.shutdown()
+
+
+@pytest.mark.parametrize("length", ["abc", "-5", "+5", "1_0", ""])
+def test_invalid_content_length(server, length):
+    request = f"POST /generate HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode()
+    status, response = asyncio.run(send(server, request))
+    assert status == 400
+    assert response == {"error": "invalid Content-Length"}
+
+
+def test_unexpected_errors_get_a_response(server):
+    async def fail(reader):
+        raise RuntimeError("boom")
+
+    server.handle_request = fail
+    status, response = asyncio.run(send(server, b"GET /health HTTP/1.1\r\n\r\n"))
+    assert status == 500
+    assert response["details"] == "RuntimeError: boom"
+
+
+def test_health(server):
+    status, response = asyncio.run(send(server, b"GET /health HTTP/1.1\r\n\r\n"))
+    assert status == 200
+    assert response["status"] == "ok"
+
+
+def test_busy_server_refuses_before_reading_the_body(server):
+    server.pending = server.args.workers + server.args.queue_size
+    # the body never arrives, so reading it would fail rather than answer
+    request = b"POST /generate HTTP/1.1\r\nContent-Length: 1000\r\n\r\n"
+    status, response = asyncio.run(send(server, request))
+    assert status == 429
+    assert server.pending == server.args.workers + server.args.queue_size
+
+
+def test_pending_counts_requests_while_their_body_arrives(server):
+    async def upload():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"POST /generate HTTP/1.1\r\nContent-Length: 10\r\n\r\n")
+        task = asyncio.create_task(server.handle_request(reader))
+        await asyncio.sleep(0)
+        pending = server.pending
+        # the client goes away before sending the body
+        reader.feed_eof()
+        with pytest.raises(asyncio.IncompleteReadError):
+            await task
+        return pending
+
+    assert asyncio.run(upload()) == 1
+    assert server.pending == 0
@@ -0,0 +1,34 @@
+import numpy as np
+
+from greedy_chooser import GreedyChooser
+from result_cache import ResultCache
+from session import ChooserSession
+
+
+def test_session_with_cache_keeps_images_apart(color_options, tmp_path):
+    chooser = GreedyChooser(color_options, cache=ResultCache(str(tmp_path)))
+    noise = np.random.default_rng(0).integers(0, 256, (40, 50, 3), dtype=np.uint8)
+    red = np.zeros((40, 50, 3), np.uint8)
+    red[..., 2] = 255
+
+    ChooserSession(chooser, noise).choose(5, 20, 16)
+    # a different image of the same shape must not reuse the noise's differences
+    session = ChooserSession(chooser, red)
+    session.choose(5, 20, 16)
+    uncached = ChooserSession(GreedyChooser(color_options), red)
+    uncached.choose(5, 20, 16)
+    assert session.selected_names == uncached.selected_names
+    assert len(np.unique(session.selected_colors)) == len(session.selected_colors)
+
+
+def test_session_after_choose_colors_with_cache(color_options, tmp_path):
+    chooser = GreedyChooser(color_options, cache=ResultCache(str(tmp_path)))
+    noise = np.random.default_rng(1).integers(0, 256, (40, 50, 3), dtype=np.uint8)
+    red = np.zeros((40, 50, 3), np.uint8)
+    red[..., 2] = 255
+
+    chooser.choose_colors(noise, 5, 20, 16)
+    pattern = ChooserSession(chooser, red).choose(5, 20, 16)
+    expected = GreedyChooser(color_options).choose_colors(red, 5, 20, 16)
+    assert pattern.names == expected.names
+    assert np.array_equal(pattern.grid, expected.grid)
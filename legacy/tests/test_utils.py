@@ -0,0 +1,84 @@
+import os
+import subprocess
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import synthetic_image
+from palette import Palette
+from utils import call_with_time_limit, quantize_img
+
+
+def reference_quantize_img(img, color_options):
+    """
+    quantize_img() as it was originally written, comparing the whole image to a
+    solid image of each palette color in turn.
+    """
+    lab_img = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    differences = np.zeros(img.shape[:2] + (len(color_options),), np.int32)
+    for i, color in enumerate(color_options.values()):
+        solid_img = np.zeros_like(img)
+        solid_img[:, :, :] = color
+        solid_img_lab = cv2.cvtColor(solid_img, cv2.COLOR_BGR2LAB)
+        diff = (lab_img.astype("float") - solid_img_lab.astype("float")) ** 2
+        differences[:, :, i] = np.sum(diff, axis=2)
+    bgr = np.array(list(color_options.values()), np.uint8)
+    return bgr[np.argmin(differences, axis=2)]
+
+
+@pytest.mark.parametrize("kind", ["photo", "flat"])
+@pytest.mark.parametrize(
+    "threads, max_band_bytes", [(1, 2**26), (1, 50_000), (3, 50_000), (3, 1)]
+)
+def test_quantize_img_matches_reference(color_options, kind, threads, max_band_bytes):
+    img = synthetic_image(kind, 83, 57)
+    palette = Palette(color_options)
+    result = quantize_img(img, palette, threads, max_band_bytes)
+    assert np.array_equal(result, reference_quantize_img(img, color_options))
+
+
+def test_quantize_img_with_table_matches_reference(color_options, tmp_path):
+    # building the table covers every BGR value, so keep the palette small
+    color_options = dict(list(color_options.items())[::10])
+    img = synthetic_image("photo", 83, 57)
+    palette = Palette(color_options, table_dir=str(tmp_path))
+    result = quantize_img(img, palette, threads=4, max_band_bytes=50_000)
+    assert np.array_equal(result, reference_quantize_img(img, color_options))
+    # and again from the saved table
+    palette = Palette(color_options, table_dir=str(tmp_path))
+    assert np.array_equal(quantize_img(img, palette), result)
+
+
+def start_and_wait(pid_path):
+    # stands in for a solver: a process of its own, which outlives its parent unless
+    # it's killed too
+    process = subprocess.Popen(["sleep", "30"])
+    with open(pid_path, "w") as f:
+        f.write(str(process.pid))
+    process.wait()
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the state follows the parenthesized command name
+            return f.read().rpartition(")")[2].split()[0] not in ("Z", "X")
+    except FileNotFoundError:
+        return False
+
+
+def test_call_with_time_limit_returns_and_raises():
+    assert call_with_time_limit(divmod, (7, 2), 10) == (3, 1)
+    with pytest.raises(ZeroDivisionError):
+        call_with_time_limit(divmod, (7, 0))
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_call_with_time_limit_kills_what_the_child_started(tmp_path):
+    pid_path = tmp_path / "pid"
+    start = time.monotonic()
+    assert call_with_time_limit(start_and_wait, (str(pid_path),), 1) is None
+    assert time.monotonic() - start < 5
+    assert not is_running(int(pid_path.read_text()))
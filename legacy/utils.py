@@ -1,68 +1,299 @@
-import cv2
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+# rough upper bound on the memory one band of quantize_indices() may use
+MAX_BAND_BYTES = 64 * 2**20
+
 
-def get_full_color_regions(width, height, color_options):
+def pack_colors(img):
     """
-    Given an image and a dictionary of the form {colorname: BGR val}, returns a
-    numpy array with a full image per BGR color value
+    Given an array of BGR colors (such as an image), return an array of the same
+    shape minus the last axis where each color is packed into one integer, 0xRRGGBB.
     """
-    full_color_regions = np.zeros((height, width, 3, len(color_options)), np.uint8)
-    for i, (name, color) in enumerate(color_options.items()):
-        solid_img = np.zeros((height, width, 3), np.uint8)
-        solid_img[:, :, :] = color
-        full_color_regions[:, :, :, i] = solid_img
-    return full_color_regions
+    img = img.astype(np.uint32)
+    return (img[..., 2] << 16) | (img[..., 1] << 8) | img[..., 0]
 
 
-def get_color_differences(img, full_color_regions):
+def unpack_colors(packed):
     """
-    Given an image and the result of get_full_color_regions(), return the
-    sum of the squared L*A*B* difference per pixel per color.
+    Inverse of pack_colors(): given packed 0xRRGGBB integers, return the BGR colors.
     """
-    rows, cols = img.shape[:2]
-    n_colors = full_color_regions.shape[3]
-    lab_img = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    packed = np.asarray(packed, np.uint32)
+    return np.stack(
+        (packed & 0xFF, (packed >> 8) & 0xFF, (packed >> 16) & 0xFF), axis=-1
+    ).astype(np.uint8)
+
+
+def compress_colors(img):
+    """
+    Collapse an image to its distinct colors. Returns a (n_unique, 1, 3) image with
+    one pixel per distinct color, the number of pixels of each color, and a
+    (rows, cols) array giving each pixel's index into the distinct colors, so a
+    per-color result can be mapped back to the grid with result[inverse].
+    """
+    packed, inverse, counts = np.unique(
+        pack_colors(img), return_inverse=True, return_counts=True
+    )
+    return (
+        unpack_colors(packed).reshape(-1, 1, 3),
+        counts,
+        inverse.reshape(img.shape[:2]),
+    )
+
+
+def get_color_differences(img, palette, colors=None):
+    """
+    Given an image and a Palette, return the difference per pixel per color by the
+    palette's metric, optionally only for the palette indices in colors.
+    """
+    return palette.differences(img, colors)
+
+
+class Deadline:
+    """
+    A time by which a chooser should be done, for anytime searches: they check
+    passed() before each improvement and stop with the best result so far once it
+    returns True. hit records whether any search was stopped that way.
+    """
+
+    def __init__(self, seconds):
+        self.end = time.monotonic() + seconds
+        self.hit = False
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+    def passed(self):
+        if time.monotonic() >= self.end:
+            self.hit = True
+        return self.hit
+
+
+def run_in_child(connection, fn, args):
+    """
+    The target of call_with_time_limit()'s child: sends back fn(*args), or the
+    exception it raised.
+    """
+    # a process group of its own, so that killing it kills any processes it starts
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        result = e
+    connection.send(result)
+
+
+def kill_process_group(process):
+    """
+    Kills a child started by call_with_time_limit() and the processes it started.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, ProcessLookupError):
+        # no process groups here, or the child hasn't made its own yet
+        process.kill()
+
+
+def call_with_time_limit(fn, args, seconds=None):
+    """
+    Calls fn(*args) in a child process and returns its result, or None if it
+    doesn't return within seconds (if given) or the child dies. When the time runs
+    out the child is killed along with any processes it started, such as a solver,
+    so the limit holds whatever fn is doing. Exceptions raised by fn are raised
+    again here. fn and args must be picklable.
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    child = multiprocessing.Process(target=run_in_child, args=(sender, fn, args))
+    child.start()
+    sender.close()
+    result = None
+    try:
+        # a child which dies closes its end of the pipe, which ends the wait too
+        if receiver.poll(seconds):
+            result = receiver.recv()
+    except EOFError:
+        pass
+    finally:
+        # the child exits by itself once it has answered; otherwise it's out of
+        # time, or this process was interrupted
+        if result is None:
+            kill_process_group(child)
+        child.join()
+        receiver.close()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
 
-    # create differences array, img_size x number of colors being considered
-    differences = np.zeros((rows, cols, n_colors), np.int32)
+def get_row_bands(rows, bytes_per_row, max_band_bytes=MAX_BAND_BYTES):
+    """
+    Split rows into consecutive slices such that each slice uses at most
+    max_band_bytes, given how many bytes processing one row takes. Every band has
+    at least one row.
+    """
+    band_rows = max(1, int(max_band_bytes // bytes_per_row))
+    return [slice(start, start + band_rows) for start in range(0, rows, band_rows)]
 
-    # for each color, make an image of entirely that color and take the squared
-    # distance ((r1-r2)^2 + (g1-b2)^2 + (b1-b2)^2) between the corresponding pixels
-    # in the image and the solid color image
-    for i in range(n_colors):
-        solid_img = full_color_regions[:, :, :, i]
-        solid_img_lab = cv2.cvtColor(solid_img, cv2.COLOR_BGR2LAB)
-        diff = lab_img.astype("float") - solid_img_lab.astype("float")
-        diff = diff ** 2
-        differences[:, :, i] = np.sum(diff, axis=2)
-    return differences
 
+def quantize_indices(img, palette, threads=1, max_band_bytes=MAX_BAND_BYTES):
+    """
+    Given an image and a Palette, returns the index of the most similar palette color
+    for every pixel, by the palette's metric.
 
-def quantize_img(img, color_options):
+    If the palette has a table_dir, this is a lookup in the palette's table of the
+    closest color to every BGR value (built on first use). Otherwise the
+    differences are computed with find_nearest_indices().
     """
-    Given an image and a dictionary of the form {colorname: BGR val}, returns an image
-    where every pixel has been replaced by the most similar color in the dictionary.
-    Similarity is determined by squared distance in the L*A*B* color space.
+    if palette.table_dir is None:
+        return find_nearest_indices(img, palette, threads, max_band_bytes)
+
+    table = palette.get_nearest_table(threads)
+    rows, cols = img.shape[:2]
+    indices = np.empty((rows, cols), table.dtype)
+    # the gather converts each channel to full size indices, so go in bands too
+    for band in get_row_bands(rows, cols * 32, max_band_bytes):
+        indices[band] = table[img[band, :, 0], img[band, :, 1], img[band, :, 2]]
+    return indices
+
+
+def find_nearest_indices(img, palette, threads=1, max_band_bytes=MAX_BAND_BYTES):
+    """
+    Given an image and a Palette, returns the index of the closest palette color for
+    every pixel by computing the differences to every palette color.
+
+    The image is processed in bands of rows so that each band stays under
+    max_band_bytes no matter how large the image is, optionally spread over a pool
+    of threads (each of which has its own band in memory).
     """
     rows, cols = img.shape[:2]
+    indices = np.empty((rows, cols), np.min_scalar_type(len(palette) - 1))
 
-    full_color_regions = get_full_color_regions(cols, rows, color_options)
-    differences = get_color_differences(img, full_color_regions)
-    new_img = np.zeros((rows, cols, 3), np.uint8)
-    # get the min difference, aka the closest color match, for each pixel in the image
-    min_indices = np.argmin(differences, axis=2)
-    x, y = np.indices(min_indices.shape)
+    def quantize_band(band):
+        # only compare each distinct color in the band against the palette once
+        unique_colors, _, inverse = compress_colors(img[band])
+        differences = get_color_differences(unique_colors, palette)[:, 0, :]
+        # get the min difference, aka the closest color match, for each distinct color
+        indices[band] = np.argmin(differences, axis=1)[inverse]
 
+    # at worst every pixel in a band is a distinct color, and each one needs the
+    # differences plus a buffer of the same size, on top of np.unique's bookkeeping
+    bytes_per_row = cols * (2 * len(palette) * palette.dtype.itemsize + 48)
+    bands = get_row_bands(rows, bytes_per_row, max_band_bytes)
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(quantize_band, bands))
+    else:
+        for band in bands:
+            quantize_band(band)
+    return indices
+
+
+def quantize_img(img, palette, threads=1, max_band_bytes=MAX_BAND_BYTES):
+    """
+    Given an image and a Palette, returns an image where every pixel has been
+    replaced by the most similar color in the palette, by the palette's metric.
+    See quantize_indices() for threads and max_band_bytes.
+    """
     # the new image becomes the best match for each pixel
-    new_img = full_color_regions[x, y, :, min_indices]
-    return new_img
+    return palette.lookup(quantize_indices(img, palette, threads, max_band_bytes))
+
+
+def calculate_total_cost(differences, selected_colors, counts=None):
+    """
+    Given color differences and an array of selected color indices, return the sum
+    over all pixels of the difference to the closest selected color. If the
+    differences are for distinct colors, counts gives the number of pixels of each.
+    """
+    min_differences = np.min(differences[..., selected_colors], axis=-1)
+    if counts is not None:
+        min_differences = min_differences * counts.reshape(min_differences.shape)
+    return np.sum(min_differences, dtype=np.float64)
 
 
-def calculate_total_cost(differences, selected_colors):
-    return np.sum(
-        np.nanmin(
-            np.multiply(differences, selected_colors.reshape(np.array([1, 1, -1]))),
-            axis=2,
-        )
+def get_nearest_two(differences, selected_colors):
+    """
+    Given color differences and a sorted array of selected color indices, return
+    per pixel the index of the closest selected color (the lowest one on ties), the
+    difference to it, and the difference to the second closest selected color. When
+    only one color is selected the second difference is the largest value the
+    differences' dtype can hold.
+    """
+    if np.issubdtype(differences.dtype, np.integer):
+        unreachable = np.iinfo(differences.dtype).max
+    else:
+        unreachable = np.inf
+
+    selected_differences = differences[..., selected_colors]
+    positions = np.expand_dims(np.argmin(selected_differences, axis=-1), -1)
+    best = np.take_along_axis(selected_differences, positions, -1)[..., 0]
+    np.put_along_axis(selected_differences, positions, unreachable, -1)
+    second = np.min(selected_differences, axis=-1)
+    return selected_colors[positions[..., 0]], best, second
+
+
+def calculate_swap_costs(new_differences, nearest, best, second, n_colors, counts=None):
+    """
+    Given the differences to a new color and the result of get_nearest_two() for the
+    current selection, return for every color index j the total cost of the selection
+    with j replaced by the new color. Only entries for selected colors are meaningful.
+    If the differences are for distinct colors, counts gives the number of pixels of
+    each.
+    """
+    # every pixel can move to the new color; pixels whose closest color is removed
+    # fall back to their second closest one if the new color isn't better
+    with_new = np.minimum(new_differences, best).astype(np.float64)
+    removal_losses = np.minimum(new_differences, second) - with_new
+    if counts is not None:
+        counts = counts.reshape(with_new.shape)
+        with_new *= counts
+        removal_losses *= counts
+    return np.sum(with_new) + np.bincount(
+        nearest.ravel(), weights=removal_losses.ravel(), minlength=n_colors
     )
+
+
+def calculate_swap_cost_matrix(
+    new_differences, nearest, best, second, selected_colors, counts=None
+):
+    """
+    Batched version of calculate_swap_costs(): given the (n_pixels, n_new)
+    differences to several new colors and the result of get_nearest_two() for the
+    current selection, return a (len(selected_colors), n_new) array of the total cost
+    of the selection with each selected color replaced by each new color.
+    """
+    if counts is None:
+        counts = np.ones(len(best))
+    counts = counts.reshape(-1, 1)
+    best = best.reshape(-1, 1)
+    second = second.reshape(-1, 1)
+
+    # as in calculate_swap_costs(), with the per removed color sums done as a
+    # product with each pixel's one-hot closest selected color
+    with_new = np.minimum(new_differences, best).astype(np.float64)
+    removal_losses = np.minimum(new_differences, second) - with_new
+    with_new *= counts
+    removal_losses *= counts
+    is_nearest = nearest.reshape(-1, 1) == selected_colors
+    return np.sum(with_new, axis=0) + is_nearest.T.astype(np.float64) @ removal_losses
+
+
+def find_knee(xs, ys):
+    """
+    Given the points of a decreasing curve, such as the cost of a template by
+    number of colors, returns the x of its knee: the point furthest below the
+    straight line from the first point to the last, once both axes are scaled to
+    [0, 1]. Past the knee, adding more makes comparatively little difference.
+    """
+    xs = np.asarray(xs, np.float64)
+    ys = np.asarray(ys, np.float64)
+    if len(xs) < 3 or ys[0] == ys[-1]:
+        return int(xs[0])
+    scaled_x = (xs - xs[0]) / (xs[-1] - xs[0])
+    scaled_y = (ys - ys[-1]) / (ys[0] - ys[-1])
+    return int(xs[np.argmax((1 - scaled_x) - scaled_y)])